@@ -0,0 +1,72 @@
+"""Micro-benchmark of the /queue/bookings response path.
+
+Compares, on synthetic rows shaped like a district's day of bookings:
+
+    model   RealDictCursor-style dicts -> QueueBookingResponse per row ->
+            FastAPI's response validation and jsonable_encoder -> json
+    direct  tuple rows -> dict(zip) -> orjson (what the endpoint does now)
+
+The rows are synthetic and importing main does not touch the database.
+
+    python bench_serialization.py --rows 2000 --repeat 20
+"""
+import argparse
+import statistics
+import time
+from datetime import date, datetime, time as dtime
+from typing import List
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+from main import QueueBookingResponse
+
+# QUEUE_BOOKING_COLUMNS selects the model fields in declaration order
+COLUMNS = list(QueueBookingResponse.model_fields)
+
+def make_rows(count: int):
+    return [
+        (i, f"Q0010803{i:03d}", "สมชาย ใจดี", "0812345678", "somchai@email.com",
+         "กรุงเทพมหานคร", "บางเขน", "ทะเบียนราษฎร",
+         date(2025, 8, 3), dtime(9, i % 60), "pending", "ต้องการทำบัตรประชาชนใหม่",
+         datetime(2025, 7, 30, 8, 30, i % 60), 1, 1, 1)
+        for i in range(count)
+    ]
+
+def model_path(rows):
+    records = [dict(zip(COLUMNS, row)) for row in rows]
+    models = [QueueBookingResponse(**record) for record in records]
+    # FastAPI validates the return value against response_model, then encodes it
+    validated = TypeAdapter(List[QueueBookingResponse]).validate_python(models)
+    return JSONResponse(jsonable_encoder(validated)).body
+
+def direct_path(rows):
+    return orjson.dumps([dict(zip(COLUMNS, row)) for row in rows])
+
+def measure(func, rows, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(rows)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert orjson.loads(direct_path(rows)) == orjson.loads(model_path(rows))
+
+    model_ms = measure(model_path, rows, args.repeat)
+    direct_ms = measure(direct_path, rows, args.repeat)
+    print(f"{args.rows} rows, median of {args.repeat}")
+    print(f"model   {model_ms:8.2f} ms")
+    print(f"direct  {direct_ms:8.2f} ms  ({model_ms / direct_ms:.1f}x faster)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Command line for the API: migrate, serve and prewarm.
+
+This is the only entry point. The ASGI apps and their Prometheus metrics
+live in main, which is imported exactly once here and handed to uvicorn as
+an import string; running main.py itself does nothing.
+
+    python cli.py serve --migrate --workers 4
+    python cli.py serve --role inference
+    python cli.py prewarm --daily-at 04:30
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import datetime, time as dtime, timedelta
+
+import main
+
+logger = logging.getLogger("poc-chatbot")
+
+def run_prewarm(args):
+    """Run prewarm_cache once, or every day at --daily-at until interrupted"""
+    while True:
+        if args.daily_at:
+            now = datetime.now()
+            next_run = datetime.combine(now.date(), args.daily_at)
+            if next_run <= now:
+                next_run += timedelta(days=1)
+            logger.info("next cache prewarm at %s", next_run)
+            time.sleep((next_run - now).total_seconds())
+        try:
+            result = main.prewarm_cache(days=args.days, top=args.top, min_asked=args.min_asked, similarity=args.similarity)
+            logger.info("cache prewarm: %s", result)
+            print(json.dumps(result))
+        except Exception as e:
+            if not args.daily_at:
+                raise
+            logger.warning("cache prewarm failed: %s", e)
+        if not args.daily_at:
+            return
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Document Management System with Queue Booking")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("migrate", help="create or upgrade the schema and exit")
+    serve = commands.add_parser("serve", help="run API or inference workers")
+    serve.add_argument("--role", choices=["api", "inference"], default="api")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, help="default 8000 for api, 8001 for inference")
+    serve.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")),
+                       help="API worker processes. /chat sessions, /query coalescing and the "
+                            "booking rate limits are per process: with more than one, a chat "
+                            "needs sticky routing by session_id, identical queries only coalesce "
+                            "within a worker, and each limit is multiplied by the worker count")
+    serve.add_argument("--migrate", action="store_true", help="run migrate before starting the workers")
+    serve.add_argument("--forwarded-allow-ips", default=main.FORWARDED_ALLOW_IPS,
+                       help="proxies whose X-Forwarded-For names the client (FORWARDED_ALLOW_IPS)")
+    prewarm = commands.add_parser("prewarm", help="precompute answers to frequently asked questions")
+    prewarm.add_argument("--days", type=int, default=7, help="query log window")
+    prewarm.add_argument("--top", type=int, default=200, help="question clusters to warm")
+    prewarm.add_argument("--min-asked", type=int, default=3, help="ignore questions asked fewer times")
+    prewarm.add_argument("--similarity", type=float, default=1 - main.SEMANTIC_CACHE_MAX_DISTANCE,
+                         help="cosine similarity for questions to share a cluster")
+    prewarm.add_argument("--daily-at", type=dtime.fromisoformat, help="keep running and warm every day at HH:MM, e.g. 04:30")
+    return parser.parse_args()
+
+def run():
+    args = parse_args()
+
+    if args.command == "prewarm":
+        run_prewarm(args)
+        return
+
+    import uvicorn
+    if args.command is None:
+        # Development: single process, schema created on start as before
+        main.init_database()
+        uvicorn.run("main:app", host="0.0.0.0", port=8000,
+                    proxy_headers=True, forwarded_allow_ips=main.FORWARDED_ALLOW_IPS)
+        return
+    if args.command == "migrate":
+        main.init_database()
+        return
+
+    if args.role == "inference" and main.EMBEDDING_BACKEND == "remote":
+        raise SystemExit("the inference role needs a local EMBEDDING_BACKEND, not remote")
+    if args.role == "api" and args.workers > 1:
+        logger.warning("%s API workers: chat sessions, query coalescing and rate limits are per worker", args.workers)
+    if args.migrate:
+        main.init_database()
+    uvicorn.run(
+        "main:app" if args.role == "api" else "main:inference_app",
+        host=args.host,
+        port=args.port or (8000 if args.role == "api" else 8001),
+        workers=args.workers,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+        timeout_graceful_shutdown=main.SHUTDOWN_GRACE_SECONDS
+    )
+
+if __name__ == "__main__":
+    run()
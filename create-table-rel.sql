@@ -11,14 +11,17 @@ CREATE TABLE IF NOT EXISTS provinces (
 CREATE TABLE IF NOT EXISTS districts (
     id SERIAL PRIMARY KEY,
     name VARCHAR(100) NOT NULL,
-    province_id INTEGER REFERENCES provinces(id) ON DELETE CASCADE
+    province_id INTEGER REFERENCES provinces(id) ON DELETE CASCADE,
+    -- Natural key the bulk hierarchy import upserts against
+    CONSTRAINT uq_district_province_name UNIQUE (province_id, name)
 );
 
 -- Services
 CREATE TABLE IF NOT EXISTS services (
     id SERIAL PRIMARY KEY,
     name VARCHAR(100) NOT NULL,
-    district_id INTEGER REFERENCES districts(id) ON DELETE CASCADE
+    district_id INTEGER REFERENCES districts(id) ON DELETE CASCADE,
+    CONSTRAINT uq_service_district_name UNIQUE (district_id, name)
 );
 
 -- Documents (now directly linked to services, no sub_services)
@@ -27,13 +30,26 @@ CREATE TABLE IF NOT EXISTS documents (
     content TEXT NOT NULL,
     service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
     embedding vector(1024),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Ingest-time summary (SUMMARY_MODE); status is pending, done or failed
+    summary TEXT,
+    key_facts JSONB,
+    summary_status VARCHAR(20),
+    -- First 1000 characters and length of content, kept by set_document_preview;
+    -- page_count is set for PDF uploads
+    content_preview TEXT,
+    content_length INTEGER,
+    page_count INTEGER
 );
 
 -- Queue Bookings
+-- Range-partitioned by month so hot-day queries only touch one partition.
+-- Queue numbers repeat every year (Q{service}{MMDD}{n}), so they are unique per day.
+CREATE SEQUENCE IF NOT EXISTS queue_bookings_id_seq;
+
 CREATE TABLE IF NOT EXISTS queue_bookings (
-    id SERIAL PRIMARY KEY,
-    queue_number VARCHAR(20) UNIQUE NOT NULL,
+    id INTEGER NOT NULL DEFAULT nextval('queue_bookings_id_seq'),
+    queue_number VARCHAR(20) NOT NULL,
     citizen_name VARCHAR(100) NOT NULL,
     citizen_phone VARCHAR(20) NOT NULL,
     citizen_email VARCHAR(100),
@@ -43,18 +59,109 @@ CREATE TABLE IF NOT EXISTS queue_bookings (
     status VARCHAR(20) DEFAULT 'pending' CHECK (status IN ('pending', 'confirmed', 'completed', 'cancelled')),
     notes TEXT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, booking_date),
+    UNIQUE (queue_number, booking_date)
+) PARTITION BY RANGE (booking_date);
+
+ALTER SEQUENCE queue_bookings_id_seq OWNED BY queue_bookings.id;
+
+-- Dates without a monthly partition land here. Only `python cli.py migrate` and
+-- POST /queue/maintenance create partitions (QUEUE_PARTITION_MONTHS_AHEAD months
+-- ahead); the booking path never does, so bookings further out fall in here.
+-- Creating their month later moves them under an ACCESS EXCLUSIVE lock on this
+-- table; /queue/maintenance reports and logs such months as default_partition_months.
+-- By hand:
+-- CREATE TABLE queue_bookings_2025_08 PARTITION OF queue_bookings
+--     FOR VALUES FROM ('2025-08-01') TO ('2025-09-01');
+CREATE TABLE IF NOT EXISTS queue_bookings_default PARTITION OF queue_bookings DEFAULT;
+
+-- Last queue number handed out per service and day (book_queue_v1); past days
+-- are pruned by POST /queue/maintenance
+CREATE TABLE IF NOT EXISTS queue_counters (
+    service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
+    booking_date DATE NOT NULL,
+    last_number INTEGER NOT NULL,
+    PRIMARY KEY (service_id, booking_date)
+);
+
+-- Completed/cancelled bookings older than QUEUE_RETENTION_DAYS (POST /queue/maintenance)
+CREATE TABLE IF NOT EXISTS queue_bookings_archive (
+    LIKE queue_bookings,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id)
+);
+
+-- Answers to past /query questions, matched by question embedding within the
+-- same service scope (0 = all documents)
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    id SERIAL PRIMARY KEY,
+    scope_key INTEGER NOT NULL DEFAULT 0,
+    question TEXT NOT NULL,
+    embedding vector(1024) NOT NULL,
+    answer TEXT NOT NULL,
+    documents JSONB NOT NULL,
+    doc_ids INTEGER[] NOT NULL,
+    top_distance REAL NOT NULL,
+    hits INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP
+);
+
+-- Stored /queue/book responses keyed by the client's Idempotency-Key
+CREATE TABLE IF NOT EXISTS booking_idempotency (
+    key VARCHAR(100) PRIMARY KEY,
+    request_hash CHAR(64) NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- /query and /query/stream requests, written in batches (QUERY_LOG); question is
+-- normalized, latency_ms holds per-stage milliseconds plus total, prefill_tokens
+-- the prompt tokens the LLM evaluated (not reused from its prefix cache)
+CREATE TABLE IF NOT EXISTS query_log (
+    id BIGSERIAL PRIMARY KEY,
+    logged_at TIMESTAMP NOT NULL,
+    endpoint VARCHAR(20) NOT NULL,
+    question TEXT NOT NULL,
+    scope_key INTEGER NOT NULL DEFAULT 0,
+    cached BOOLEAN,
+    coalesced BOOLEAN DEFAULT FALSE,
+    latency_ms JSONB,
+    doc_ids INTEGER[],
+    prefill_tokens INTEGER
+);
+
+-- Embeddings of frequently asked (normalized) questions, stored by python cli.py prewarm
+CREATE TABLE IF NOT EXISTS question_embeddings (
+    question TEXT PRIMARY KEY,
+    embedding vector(1024) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Indexes for fast filtering
 CREATE INDEX IF NOT EXISTS idx_district_province ON districts(province_id);
 CREATE INDEX IF NOT EXISTS idx_service_district ON services(district_id);
 CREATE INDEX IF NOT EXISTS idx_document_service ON documents(service_id);
-CREATE INDEX IF NOT EXISTS idx_queue_service ON queue_bookings(service_id);
-CREATE INDEX IF NOT EXISTS idx_queue_date ON queue_bookings(booking_date);
-CREATE INDEX IF NOT EXISTS idx_queue_status ON queue_bookings(status);
-CREATE INDEX IF NOT EXISTS idx_queue_number ON queue_bookings(queue_number);
-CREATE INDEX IF NOT EXISTS idx_queue_citizen_phone ON queue_bookings(citizen_phone);
+-- /search/suggestions matches content_preview with ILIKE
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_document_preview_trgm ON documents USING gin (content_preview gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_embedding ON semantic_cache USING hnsw (embedding vector_cosine_ops);
+CREATE INDEX IF NOT EXISTS idx_semantic_cache_doc_ids ON semantic_cache USING gin (doc_ids);
+CREATE INDEX IF NOT EXISTS idx_query_log_logged_at ON query_log(logged_at);
+CREATE INDEX IF NOT EXISTS idx_queue_service_date_status ON queue_bookings(service_id, booking_date, status);
+CREATE INDEX IF NOT EXISTS idx_queue_phone_service_date ON queue_bookings(citizen_phone, service_id, booking_date);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_queue_live_booking ON queue_bookings(citizen_phone, service_id, booking_date) WHERE status <> 'cancelled';
+CREATE INDEX IF NOT EXISTS idx_queue_archive_service_date ON queue_bookings_archive(service_id, booking_date);
+
+-- Quantized ANN indexes for documents.embedding (pick one, see VECTOR_STORAGE).
+-- The full-precision column is kept for rescoring the ANN candidates.
+-- VECTOR_STORAGE=halfvec
+-- CREATE INDEX IF NOT EXISTS idx_document_embedding_halfvec ON documents
+--     USING hnsw ((embedding::halfvec(1024)) halfvec_cosine_ops);
+-- VECTOR_STORAGE=binary
+-- CREATE INDEX IF NOT EXISTS idx_document_embedding_bit ON documents
+--     USING hnsw ((binary_quantize(embedding)::bit(1024)) bit_hamming_ops);
 
 -- Function to automatically update updated_at timestamp
 CREATE OR REPLACE FUNCTION update_updated_at_column()
@@ -65,6 +172,20 @@ BEGIN
 END;
 $$ language 'plpgsql';
 
+-- Keep documents.content_preview/content_length in step with content
+CREATE OR REPLACE FUNCTION set_document_preview()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.content_preview = left(NEW.content, 1000);
+    NEW.content_length = char_length(NEW.content);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER set_document_preview
+    BEFORE INSERT OR UPDATE OF content ON documents
+    FOR EACH ROW EXECUTE FUNCTION set_document_preview();
+
 -- Trigger to automatically update updated_at on queue_bookings
 CREATE TRIGGER update_queue_bookings_updated_at 
     BEFORE UPDATE ON queue_bookings 
@@ -73,6 +194,57 @@ CREATE TRIGGER update_queue_bookings_updated_at
 
 
 
+-- POST /queue/book books through the plpgsql function book_queue_v1 (prepared
+-- as book_queue). Its only definition is BOOK_QUEUE_FUNCTION in main.py; run
+-- python cli.py migrate to create or update it.
+
+-- Which documents changed, for API workers running RETRIEVAL_BACKEND=memory.
+-- A NULL document_id forces a full rebuild (TRUNCATE, reembed.py --switch).
+-- Updates are logged only when embedding, service_id or content change.
+CREATE TABLE IF NOT EXISTS document_changes (
+    seq BIGSERIAL PRIMARY KEY,
+    document_id INTEGER,
+    xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_document_changes_xid ON document_changes(xid);
+
+CREATE OR REPLACE FUNCTION log_document_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        INSERT INTO document_changes (document_id) VALUES (NULL);
+    ELSIF TG_LEVEL = 'ROW' THEN
+        INSERT INTO document_changes (document_id) VALUES (NEW.id);
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO document_changes (document_id) SELECT id FROM old_rows;
+    ELSE
+        INSERT INTO document_changes (document_id) SELECT id FROM new_rows;
+    END IF;
+    PERFORM pg_notify('document_changes', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER documents_changes_insert
+    AFTER INSERT ON documents REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+CREATE OR REPLACE TRIGGER documents_changes_update
+    AFTER UPDATE OF embedding, service_id, content, summary, key_facts ON documents
+    FOR EACH ROW
+    WHEN (OLD.embedding IS DISTINCT FROM NEW.embedding
+          OR OLD.service_id IS DISTINCT FROM NEW.service_id
+          OR OLD.content IS DISTINCT FROM NEW.content
+          OR OLD.summary IS DISTINCT FROM NEW.summary
+          OR OLD.key_facts IS DISTINCT FROM NEW.key_facts)
+    EXECUTE FUNCTION log_document_changes();
+CREATE OR REPLACE TRIGGER documents_changes_delete
+    AFTER DELETE ON documents REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+CREATE OR REPLACE TRIGGER documents_changes_truncate
+    AFTER TRUNCATE ON documents
+    FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+
 -- Views for easier querying
 CREATE OR REPLACE VIEW service_details AS
 SELECT 
@@ -0,0 +1,101 @@
+"""Compare embedding runtime settings on latency and retrieval quality.
+
+Each configuration is loaded through main.load_embedder() and run against a
+sample of stored documents. Retrieval quality is measured label-free: a
+snippet from the middle of every document is used as the query and the
+document it came from is the expected hit.
+
+    python embedding_report.py --limit 200 --config torch --config onnx-int8 --config torch-dim512
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from main import get_db_connection, load_embedder, EMBEDDING_MODEL
+
+CONFIGS = {
+    "torch": {"backend": "torch"},
+    "torch-int8": {"backend": "torch", "quantize": "int8"},
+    "onnx": {"backend": "onnx"},
+    "onnx-int8": {"backend": "onnx", "model_file": "onnx/model_qint8_avx512_vnni.onnx"},
+    "torch-seq256": {"backend": "torch", "max_seq_length": 256},
+    "torch-dim512": {"backend": "torch", "dim": 512},
+    "torch-dim256": {"backend": "torch", "dim": 256},
+}
+
+def load_corpus(limit: int):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, content FROM documents ORDER BY id LIMIT %s", (limit,))
+        return cur.fetchall()
+
+def make_query(content: str, length: int = 120) -> str:
+    start = max(0, len(content) // 2 - length // 2)
+    return content[start:start + length]
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def evaluate(name: str, options: dict, documents, threads: int):
+    kwargs = {"model_name": EMBEDDING_MODEL, "model_file": None, "quantize": "", "threads": threads,
+              "max_seq_length": 0, "dim": 1024}
+    kwargs.update(options)
+
+    started = time.perf_counter()
+    model = load_embedder(**kwargs)
+    load_seconds = time.perf_counter() - started
+
+    contents = [content for _, content in documents]
+    queries = [make_query(content) for content in contents]
+
+    started = time.perf_counter()
+    doc_vectors = model.encode(contents, batch_size=32, normalize_embeddings=True)
+    corpus_seconds = time.perf_counter() - started
+
+    query_latencies = []
+    query_vectors = []
+    for query in queries:
+        started = time.perf_counter()
+        query_vectors.append(model.encode(query, normalize_embeddings=True))
+        query_latencies.append((time.perf_counter() - started) * 1000)
+
+    scores = np.asarray(query_vectors) @ np.asarray(doc_vectors).T
+    ranks = (scores > scores.diagonal()[:, None]).sum(axis=1) + 1
+
+    return {
+        "config": name,
+        "dim": kwargs["dim"],
+        "load_s": load_seconds,
+        "docs_per_s": len(contents) / corpus_seconds if corpus_seconds else 0.0,
+        "query_p50_ms": statistics.median(query_latencies),
+        "query_p95_ms": percentile(query_latencies, 95),
+        "hit_at_1": float((ranks == 1).mean()),
+        "mrr": float((1.0 / ranks).mean()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", action="append", choices=sorted(CONFIGS), help="configuration to compare (repeatable)")
+    parser.add_argument("--limit", type=int, default=200, help="number of stored documents to sample")
+    parser.add_argument("--threads", type=int, default=0, help="inference threads, 0 for the library default")
+    args = parser.parse_args()
+
+    documents = load_corpus(args.limit)
+    if not documents:
+        raise SystemExit("documents table is empty")
+
+    results = [evaluate(name, CONFIGS[name], documents, args.threads) for name in (args.config or ["torch"])]
+
+    header = f"{'config':<14}{'dim':>6}{'load s':>9}{'docs/s':>9}{'q p50 ms':>10}{'q p95 ms':>10}{'hit@1':>8}{'mrr':>8}"
+    print(f"{len(documents)} documents")
+    print(header)
+    for row in results:
+        print(f"{row['config']:<14}{row['dim']:>6}{row['load_s']:>9.1f}{row['docs_per_s']:>9.1f}"
+              f"{row['query_p50_ms']:>10.1f}{row['query_p95_ms']:>10.1f}{row['hit_at_1']:>8.3f}{row['mrr']:>8.3f}")
+
+if __name__ == "__main__":
+    main()
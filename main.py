@@ -1,22 +1,47 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, Form, Header, HTTPException, Request, Response
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime, date, time
+from datetime import datetime, date, time as dtime, timedelta
 from enum import Enum
 import ollama
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.pool
+from psycopg2.extras import Json, RealDictCursor, execute_values
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
 import os
+import asyncio
 import PyPDF2
 import io
+import csv
+import json
+import random
+import time
+import threading
+import hashlib
+import logging
+import re
+import uuid
+import contextvars
+import fcntl
+import select
+import numpy as np
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
 
 load_dotenv()
 
-app = FastAPI(title="Document Management System with Queue Booking", version="3.0.0")
+logger = logging.getLogger("poc-chatbot")
+
+app = FastAPI(
+    title="Document Management System with Queue Booking",
+    version="3.0.0",
+    default_response_class=ORJSONResponse
+)
 
 origins = [
     "http://localhost:3000",       
@@ -33,7 +58,268 @@ app.add_middleware(
 )
 
 db_url = os.getenv("DATABASE_URL")
-embedder = SentenceTransformer("BAAI/bge-m3")
+
+# Optional read replicas for read-only endpoints and retrieval, comma-separated
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv("REPLICA_LAG_CHECK_SECONDS", "2"))
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# A pooled connection idle for longer than this is pinged before it is handed out
+DB_POOL_PING_SECONDS = float(os.getenv("DB_POOL_PING_SECONDS", "30"))
+
+# queue_bookings is range-partitioned by month on booking_date; migrate and
+# /queue/maintenance keep partitions this many months ahead of the current one
+# (never the booking path, ATTACH locks the parent). Later dates wait in the
+# default partition until their month is created.
+QUEUE_PARTITION_MONTHS_AHEAD = int(os.getenv("QUEUE_PARTITION_MONTHS_AHEAD", "3"))
+# Completed/cancelled bookings older than this move to queue_bookings_archive
+QUEUE_RETENTION_DAYS = int(os.getenv("QUEUE_RETENTION_DAYS", "180"))
+
+# /queue/book guards. Token buckets are per process, so with N workers the
+# effective limit is up to N times these numbers.
+BOOKING_RATE_LIMIT = os.getenv("BOOKING_RATE_LIMIT", "1") == "1"
+BOOKING_PHONE_BURST = int(os.getenv("BOOKING_PHONE_BURST", "3"))
+BOOKING_PHONE_PER_HOUR = float(os.getenv("BOOKING_PHONE_PER_HOUR", "6"))
+BOOKING_IP_BURST = int(os.getenv("BOOKING_IP_BURST", "30"))
+BOOKING_IP_PER_MINUTE = float(os.getenv("BOOKING_IP_PER_MINUTE", "60"))
+# The per-IP bucket keys on request.client. Behind a reverse proxy that is the
+# proxy's address for every citizen, so list the proxy here (comma-separated,
+# "*" for any) and uvicorn takes the client from its X-Forwarded-For instead.
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# A key still without a stored response after this long belongs to a crashed request
+IDEMPOTENCY_PENDING_SECONDS = int(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "60"))
+
+# Embedding runtime options, see load_embedder()
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-m3")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE")
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "").lower()
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "0"))
+# Must match the documents.embedding vector(N) column; smaller than the model's
+# native size truncates Matryoshka-style
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1024"))
+# EMBEDDING_BACKEND=remote sends texts to an inference worker
+# (python cli.py serve --role inference) instead of loading the model here
+INFERENCE_URL = os.getenv("INFERENCE_URL", "http://127.0.0.1:8001")
+
+# How long a stopping worker waits for in-flight requests and /query streams
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "30"))
+
+# Semantic answer cache for /query: a question whose embedding is within
+# SEMANTIC_CACHE_MAX_DISTANCE (cosine distance) of a cached one under the same
+# service scope gets the cached answer. SEMANTIC_CACHE_VERIFY_RATE of hits
+# still run retrieval to detect false hits.
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.08"))
+SEMANTIC_CACHE_TTL_HOURS = float(os.getenv("SEMANTIC_CACHE_TTL_HOURS", "168"))
+SEMANTIC_CACHE_VERIFY_RATE = float(os.getenv("SEMANTIC_CACHE_VERIFY_RATE", "0.05"))
+
+# /query and /query/stream requests are logged to query_log from a background
+# thread in batches; when the buffer is full new entries are dropped, never waited on
+QUERY_LOG = os.getenv("QUERY_LOG", "1") == "1"
+QUERY_LOG_BATCH_SIZE = int(os.getenv("QUERY_LOG_BATCH_SIZE", "200"))
+QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "2"))
+QUERY_LOG_MAX_PENDING = int(os.getenv("QUERY_LOG_MAX_PENDING", "10000"))
+QUERY_LOG_RETENTION_DAYS = int(os.getenv("QUERY_LOG_RETENTION_DAYS", "30"))
+
+# Ingest-time document summaries: off, extractive (rule-based, no model) or
+# llm. They are written in the background after a document is saved, and
+# PROMPT_CONTEXT_SOURCE=summary puts them in prompts instead of raw text.
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "off").lower()
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "400"))
+SUMMARY_MAX_FACTS = int(os.getenv("SUMMARY_MAX_FACTS", "8"))
+PROMPT_CONTEXT_SOURCE = os.getenv("PROMPT_CONTEXT_SOURCE", "content").lower()
+
+# Leading characters of each document kept in documents.content_preview; the
+# prompt context and listings read it instead of detoasting the full content
+DOCUMENT_PREVIEW_CHARS = 1000
+DOCUMENT_CONTENT_CHUNK = int(os.getenv("DOCUMENT_CONTENT_CHUNK", "20000"))
+
+if SUMMARY_MODE not in ("off", "extractive", "llm"):
+    raise RuntimeError(f"SUMMARY_MODE must be off, extractive or llm, got {SUMMARY_MODE!r}")
+
+# ollama (default) or stub, a deterministic offline answer for benchmarks
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama").lower()
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:3b")
+# ollama keeps the model, and the KV cache of the last prompt per slot, loaded
+# this long; a prompt sharing its prefix only prefills the tokens after it.
+# num_ctx is pinned because a different value per request reloads the model.
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "4096"))
+
+# /chat sessions live in process memory and expire after this much idle time
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", "1800"))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "10000"))
+CHAT_MAX_TURNS = int(os.getenv("CHAT_MAX_TURNS", "6"))
+# A follow-up keeps the previous turn's documents while its rewritten question
+# stays at least this cosine-similar to the topic
+CHAT_TOPIC_SIMILARITY = float(os.getenv("CHAT_TOPIC_SIMILARITY", "0.75"))
+
+# How document embeddings are indexed for ANN search:
+#   vector  - exact scan over the full-precision column (default)
+#   halfvec - HNSW over embedding::halfvec, candidates rescored at full precision
+#   binary  - HNSW over binary_quantize(embedding), candidates rescored at full precision
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "vector").lower()
+VECTOR_STORAGE_MODES = ("vector", "halfvec", "binary")
+VECTOR_RESCORE_CANDIDATES = int(os.getenv("VECTOR_RESCORE_CANDIDATES", "40"))
+
+if VECTOR_STORAGE not in VECTOR_STORAGE_MODES:
+    raise RuntimeError(f"VECTOR_STORAGE must be one of {VECTOR_STORAGE_MODES}, got {VECTOR_STORAGE!r}")
+
+# Where /query retrieval runs:
+#   pgvector - a query against documents per search (default)
+#   memory   - brute-force NumPy search over a memory-mapped snapshot of every
+#              embedding in VECTOR_INDEX_DIR, shared through the page cache by
+#              all workers on the host and kept current from document_changes.
+#              Falls back to pgvector until the snapshot is loaded.
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pgvector").lower()
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "./vector_index")
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float32").lower()
+VECTOR_INDEX_POLL_SECONDS = float(os.getenv("VECTOR_INDEX_POLL_SECONDS", "5"))
+# Changed documents are searched from a small in-process delta until this many
+# pile up, then the snapshot is rewritten
+VECTOR_INDEX_REBUILD_DELTA = int(os.getenv("VECTOR_INDEX_REBUILD_DELTA", "2000"))
+VECTOR_INDEX_METADATA_CACHE = int(os.getenv("VECTOR_INDEX_METADATA_CACHE", "5000"))
+
+if RETRIEVAL_BACKEND not in ("pgvector", "memory"):
+    raise RuntimeError(f"RETRIEVAL_BACKEND must be pgvector or memory, got {RETRIEVAL_BACKEND!r}")
+if VECTOR_INDEX_DTYPE not in ("float16", "float32"):
+    raise RuntimeError(f"VECTOR_INDEX_DTYPE must be float16 or float32, got {VECTOR_INDEX_DTYPE!r}")
+
+# Statements slower than this are logged with their SQL and parameter shape
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "0") == "1"
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+# Per-request stage milliseconds for the query log; run_in_threadpool copies
+# the context, so stages timed in the worker thread land in the caller's dict
+STAGE_TIMINGS = contextvars.ContextVar("stage_timings", default=None)
+# Prompt token counts of the request's LLM calls, shared the same way
+PREFILL_TOKENS = contextvars.ContextVar("prefill_tokens", default=None)
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds", "Latency of one stage of request handling", ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+SQL_LATENCY = Histogram(
+    "sql_statement_duration_seconds", "SQL statement execution latency", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+SLOW_QUERIES = Counter("sql_slow_queries_total", "Statements slower than SLOW_QUERY_MS", ["statement"])
+LLM_PREFILL_TOKENS = Histogram(
+    "llm_prefill_tokens", "Prompt tokens the LLM evaluated per request (tokens reused from its cache excluded)",
+    buckets=(0, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+
+tracer = None
+if TRACING_ENABLED:
+    try:
+        from opentelemetry import trace
+        tracer = trace.get_tracer("poc-chatbot")
+    except ImportError:
+        logger.warning("TRACING_ENABLED=1 but opentelemetry is not installed, spans are disabled")
+
+@contextmanager
+def stage(name: str):
+    """Time one stage into STAGE_LATENCY, inside a tracing span when enabled.
+
+    Also adds the milliseconds to the request's STAGE_TIMINGS dict, if one is set.
+    """
+    started = time.perf_counter()
+    try:
+        if tracer is not None:
+            with tracer.start_as_current_span(name):
+                yield
+        else:
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_LATENCY.labels(name).observe(elapsed)
+        timings = STAGE_TIMINGS.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+_SQL_TARGET = {
+    "select": re.compile(r"\bFROM\s+(\w+)", re.I),
+    "with": re.compile(r"\bFROM\s+(\w+)", re.I),
+    "insert": re.compile(r"\bINTO\s+(\w+)", re.I),
+    "update": re.compile(r"^\s*UPDATE\s+(\w+)", re.I),
+    "delete": re.compile(r"\bFROM\s+(\w+)", re.I),
+    "copy": re.compile(r"^\s*COPY\s+(\w+)", re.I),
+    "prepare": re.compile(r"^\s*PREPARE\s+(\w+)", re.I),
+    "execute": re.compile(r"^\s*EXECUTE\s+(\w+)", re.I),
+}
+
+def statement_label(query) -> str:
+    """Low-cardinality label for a statement, e.g. ``select:documents``"""
+    text = query.decode() if isinstance(query, bytes) else str(query)
+    words = text.split(None, 1)
+    if not words:
+        return "empty"
+    verb = words[0].lower()
+    pattern = _SQL_TARGET.get(verb)
+    match = pattern.search(text) if pattern else None
+    return f"{verb}:{match.group(1).lower()}" if match else verb
+
+def describe_params(params):
+    """Parameter shape for the slow-query log, without the values themselves"""
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: describe_params(value) for key, value in params.items()}
+    if isinstance(params, (list, tuple)):
+        if len(params) > 8:
+            return f"{type(params).__name__}[{len(params)}]"
+        return [describe_params(value) for value in params]
+    if isinstance(params, str):
+        return f"str({len(params)})"
+    return type(params).__name__
+
+def record_sql(query, params, seconds: float):
+    label = statement_label(query)
+    SQL_LATENCY.labels(label).observe(seconds)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.labels(label).inc()
+        text = " ".join(str(query).split())
+        logger.warning("slow query %.1fms [%s] %s params=%s", seconds * 1000, label, text[:500], describe_params(params))
+
+class InstrumentedCursorMixin:
+    """Times every execute/copy into SQL_LATENCY and the slow-query log"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_sql(query, vars, time.perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_sql(sql, None, time.perf_counter() - started)
+
+_instrumented_cursor_classes = {}
+
+def instrumented_cursor_class(factory):
+    cls = _instrumented_cursor_classes.get(factory)
+    if cls is None:
+        cls = type(f"Instrumented{factory.__name__}", (InstrumentedCursorMixin, factory), {})
+        _instrumented_cursor_classes[factory] = cls
+    return cls
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Connection whose cursors, whatever their cursor_factory, are instrumented"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = instrumented_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
 
 class QueueStatus(str, Enum):
     PENDING = "pending"
@@ -41,12 +327,20 @@ class QueueStatus(str, Enum):
     COMPLETED = "completed"
     CANCELLED = "cancelled"
 
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+
 class TextInput(BaseModel):
     text: str
     service_id: int
 
 class QueryRequest(BaseModel):
     question: str
+    # Restrict retrieval to one service's documents
+    service_id: Optional[int] = None
+    # Keys to keep in each relevant_documents entry (RELEVANT_DOCUMENT_FIELDS); all when unset
+    fields: Optional[List[str]] = None
 
 class DocumentResponse(BaseModel):
     id: int
@@ -69,6 +363,22 @@ class ServiceRelation(BaseModel):
 class QueryResponse(BaseModel):
     answer: str
     relevant_documents: List[dict]
+    cached: bool = False
+    cache_entry_id: Optional[int] = None
+
+class ChatRequest(BaseModel):
+    question: str
+    session_id: Optional[str] = None
+
+class ChatResponse(BaseModel):
+    session_id: str
+    answer: str
+    standalone_question: str
+    reused_context: bool
+    relevant_documents: List[dict]
+    # Prompt tokens the LLM evaluated for this turn and how long that took; null for the stub backend
+    prefill_tokens: Optional[int] = None
+    prefill_ms: Optional[float] = None
 
 class QueueBookingCreate(BaseModel):
     citizen_name: str
@@ -76,7 +386,7 @@ class QueueBookingCreate(BaseModel):
     citizen_email: Optional[str] = None
     service_id: int
     booking_date: date
-    booking_time: time
+    booking_time: dtime
     notes: Optional[str] = None
 
 class QueueBookingResponse(BaseModel):
@@ -89,7 +399,7 @@ class QueueBookingResponse(BaseModel):
     district_name: str
     service_name: str
     booking_date: date
-    booking_time: time
+    booking_time: dtime
     status: QueueStatus
     notes: Optional[str]
     created_at: datetime
@@ -111,19 +421,163 @@ class ProvinceCreate(BaseModel):
 class ProvinceUpdate(BaseModel):
     name: str
 
+DB_ROUTE = Counter("db_route_total", "Connections handed out per routing decision", ["target"])
+
+class ConnectionPool:
+    """Thread-safe pool for one DSN, opened on first use.
+
+    When every pooled connection is busy an extra one is opened and closed
+    after use instead of failing the request. Connections the server dropped
+    (restart, failover) are discarded on checkout rather than failing a request.
+    """
+
+    def __init__(self, dsn: str, minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, self.dsn, connection_factory=InstrumentedConnection
+                    )
+        return self._pool
+
+    @staticmethod
+    def alive(conn) -> bool:
+        """poll() reads a pending termination notice without a round trip; long-idle ones also get SELECT 1"""
+        returned_at = getattr(conn, "returned_at", None)
+        try:
+            conn.poll()
+            if not conn.closed and returned_at is not None and time.monotonic() - returned_at > DB_POOL_PING_SECONDS:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        return not conn.closed
+
+    def getconn(self):
+        """Return (connection, pooled)"""
+        pool = self._get_pool()
+        # After a server restart every pooled connection may be dead; the pool
+        # opens a fresh one once the dead ones are discarded
+        for _ in range(self.maxconn + 1):
+            try:
+                conn = pool.getconn()
+            except psycopg2.pool.PoolError:
+                break
+            if self.alive(conn):
+                return conn, True
+            pool.putconn(conn, close=True)
+        return psycopg2.connect(self.dsn, connection_factory=InstrumentedConnection), False
+
+    def putconn(self, conn, pooled: bool):
+        if not pooled:
+            conn.close()
+            return
+        conn.returned_at = time.monotonic()
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = False
+            except psycopg2.Error:
+                broken = True
+        self._get_pool().putconn(conn, close=broken)
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+class Replica:
+    def __init__(self, dsn: str):
+        self.pool = ConnectionPool(dsn)
+        self.lag = None
+        self.checked_at = 0.0
+
+    def usable(self) -> bool:
+        """Reachable and within REPLICA_MAX_LAG_SECONDS, rechecked at most every REPLICA_LAG_CHECK_SECONDS"""
+        now = time.monotonic()
+        if now - self.checked_at >= REPLICA_LAG_CHECK_SECONDS:
+            self.checked_at = now
+            conn = None
+            try:
+                conn, pooled = self.pool.getconn()
+                cur = conn.cursor()
+                cur.execute(_LAG_QUERY)
+                self.lag = float(cur.fetchone()[0])
+            except psycopg2.Error as e:
+                logger.warning("replica unavailable, reads go to the primary: %s", e)
+                self.lag = None
+            finally:
+                if conn is not None:
+                    self.pool.putconn(conn, pooled)
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG_SECONDS
+
+primary_pool = ConnectionPool(db_url)
+replicas = [Replica(url) for url in DATABASE_REPLICA_URLS]
+_replica_turn = 0
+
+def choose_pool(readonly: bool) -> ConnectionPool:
+    """Primary for writes; round-robin over reachable, caught-up replicas for reads"""
+    global _replica_turn
+    if not readonly:
+        DB_ROUTE.labels("primary").inc()
+        return primary_pool
+    for _ in range(len(replicas)):
+        _replica_turn = (_replica_turn + 1) % len(replicas)
+        replica = replicas[_replica_turn]
+        if replica.usable():
+            DB_ROUTE.labels("replica").inc()
+            return replica.pool
+    DB_ROUTE.labels("primary_fallback" if replicas else "primary").inc()
+    return primary_pool
+
 @contextmanager
-def get_db_connection():
+def get_db_connection(readonly: bool = False):
+    """Borrow a pooled connection.
+
+    readonly=True may be served by a replica, so only use it where slightly
+    stale data is fine; reads that must see the caller's own writes (a
+    booking fetched right after it was made) stay on the primary.
+    """
     conn = None
+    pool = choose_pool(readonly)
     try:
-        conn = psycopg2.connect(db_url)
+        with stage("db_acquire"):
+            try:
+                conn, pooled = pool.getconn()
+            except psycopg2.OperationalError:
+                if pool is primary_pool:
+                    raise
+                # Replica went away between its health check and now
+                DB_ROUTE.labels("primary_fallback").inc()
+                pool = primary_pool
+                conn, pooled = pool.getconn()
         yield conn
     except Exception as e:
-        if conn:
+        if conn and not conn.closed:
             conn.rollback()
         raise e
     finally:
         if conn:
-            conn.close()
+            pool.putconn(conn, pooled)
 
 def init_database():
     with get_db_connection() as conn:
@@ -131,7 +585,7 @@ def init_database():
         try:
             cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
 
-            cur.execute("""
+            cur.execute(f"""
                 CREATE TABLE IF NOT EXISTS provinces (
                     id SERIAL PRIMARY KEY,
                     name VARCHAR(100) UNIQUE NOT NULL
@@ -153,32 +607,78 @@ def init_database():
                     id SERIAL PRIMARY KEY,
                     content TEXT NOT NULL,
                     service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
-                    embedding vector(1024),
+                    embedding vector({EMBEDDING_DIM}),
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
 
-                CREATE TABLE IF NOT EXISTS queue_bookings (
+                CREATE TABLE IF NOT EXISTS semantic_cache (
                     id SERIAL PRIMARY KEY,
-                    queue_number VARCHAR(20) UNIQUE NOT NULL,
-                    citizen_name VARCHAR(100) NOT NULL,
-                    citizen_phone VARCHAR(20) NOT NULL,
-                    citizen_email VARCHAR(100),
-                    service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
-                    booking_date DATE NOT NULL,
-                    booking_time TIME NOT NULL,
-                    status VARCHAR(20) DEFAULT 'pending',
-                    notes TEXT,
+                    scope_key INTEGER NOT NULL DEFAULT 0,
+                    question TEXT NOT NULL,
+                    embedding vector({EMBEDDING_DIM}) NOT NULL,
+                    answer TEXT NOT NULL,
+                    documents JSONB NOT NULL,
+                    doc_ids INTEGER[] NOT NULL,
+                    top_distance REAL NOT NULL,
+                    hits INTEGER DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    last_hit_at TIMESTAMP
+                );
+
+                CREATE TABLE IF NOT EXISTS booking_idempotency (
+                    key VARCHAR(100) PRIMARY KEY,
+                    request_hash CHAR(64) NOT NULL,
+                    response JSONB,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+
+                CREATE TABLE IF NOT EXISTS query_log (
+                    id BIGSERIAL PRIMARY KEY,
+                    logged_at TIMESTAMP NOT NULL,
+                    endpoint VARCHAR(20) NOT NULL,
+                    question TEXT NOT NULL,
+                    scope_key INTEGER NOT NULL DEFAULT 0,
+                    cached BOOLEAN,
+                    coalesced BOOLEAN DEFAULT FALSE,
+                    latency_ms JSONB,
+                    doc_ids INTEGER[],
+                    prefill_tokens INTEGER
+                );
+
+                CREATE TABLE IF NOT EXISTS question_embeddings (
+                    question TEXT PRIMARY KEY,
+                    embedding vector({EMBEDDING_DIM}) NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
             """)
 
+            create_queue_bookings(cur)
+
             cur.execute("CREATE INDEX IF NOT EXISTS idx_district_province ON districts(province_id);")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_service_district ON services(district_id);")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_document_service ON documents(service_id);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_service ON queue_bookings(service_id);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_date ON queue_bookings(booking_date);")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_status ON queue_bookings(status);")
+            cur.execute("""
+                ALTER TABLE documents
+                    ADD COLUMN IF NOT EXISTS summary TEXT,
+                    ADD COLUMN IF NOT EXISTS key_facts JSONB,
+                    ADD COLUMN IF NOT EXISTS summary_status VARCHAR(20),
+                    ADD COLUMN IF NOT EXISTS content_preview TEXT,
+                    ADD COLUMN IF NOT EXISTS content_length INTEGER,
+                    ADD COLUMN IF NOT EXISTS page_count INTEGER;
+            """)
+            cur.execute("ALTER TABLE query_log ADD COLUMN IF NOT EXISTS prefill_tokens INTEGER;")
+            create_document_preview_trigger(cur)
+            create_document_search_index(cur)
+            create_document_change_log(cur)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_semantic_cache_embedding ON semantic_cache USING hnsw (embedding vector_cosine_ops);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_semantic_cache_doc_ids ON semantic_cache USING gin (doc_ids);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_query_log_logged_at ON query_log(logged_at);")
+            create_natural_keys(cur)
+
+            for statement in vector_index_statements(VECTOR_STORAGE):
+                cur.execute(statement)
+
+            check_embedding_dimension(cur)
 
             conn.commit()
         except Exception as e:
@@ -187,11 +687,523 @@ def init_database():
         finally:
             cur.close()
 
-init_database()
+def create_natural_keys(cur):
+    """Unique names per parent, which the bulk hierarchy import upserts against.
 
-def get_service_by_id(service_id: int):
+    Older databases may hold duplicates created through the plain CRUD
+    endpoints; merging them means repointing documents and bookings, so
+    migrate stops and names them instead of guessing.
+    """
+    for table, parent, constraint in (("districts", "province_id", "uq_district_province_name"),
+                                      ("services", "district_id", "uq_service_district_name")):
+        cur.execute("SELECT 1 FROM pg_constraint WHERE conname = %s", (constraint,))
+        if cur.fetchone():
+            continue
+        cur.execute(f"""
+            SELECT {parent}, name, array_agg(id ORDER BY id) FROM {table}
+            GROUP BY {parent}, name HAVING COUNT(*) > 1
+            ORDER BY {parent}, name LIMIT 20
+        """)
+        duplicates = cur.fetchall()
+        if duplicates:
+            raise RuntimeError(
+                f"{table} has duplicate names under the same {parent}; merge these ({parent}, name, ids) "
+                f"and rerun migrate: {duplicates}"
+            )
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE ({parent}, name)")
+        # The constraint's index replaces the plain lookup index earlier versions created
+        cur.execute(f"DROP INDEX IF EXISTS {constraint.replace('uq_', 'idx_', 1)}")
+
+def create_document_preview_trigger(cur):
+    """Keep content_preview/content_length in step with content, whoever writes it (API, COPY, SQL)"""
+    # content keeps the default compressed storage (Thai text compresses well).
+    # Undo the EXTERNAL setting earlier versions applied; the catalog check
+    # keeps the ACCESS EXCLUSIVE ALTER off every later startup.
+    cur.execute("""
+        SELECT attstorage FROM pg_attribute
+        WHERE attrelid = 'documents'::regclass AND attname = 'content'
+    """)
+    if cur.fetchone()[0] == "e":
+        cur.execute("ALTER TABLE documents ALTER COLUMN content SET STORAGE EXTENDED")
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION set_document_preview()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            NEW.content_preview = left(NEW.content, {DOCUMENT_PREVIEW_CHARS});
+            NEW.content_length = char_length(NEW.content);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE TRIGGER set_document_preview
+            BEFORE INSERT OR UPDATE OF content ON documents
+            FOR EACH ROW EXECUTE FUNCTION set_document_preview();
+    """)
+    cur.execute(f"""
+        UPDATE documents
+        SET content_preview = left(content, {DOCUMENT_PREVIEW_CHARS}), content_length = char_length(content)
+        WHERE content_length IS NULL
+    """)
+    if cur.rowcount:
+        logger.info("backfilled content_preview for %s documents", cur.rowcount)
+
+def create_document_search_index(cur):
+    """Trigram index behind /search/suggestions' ILIKE on content_preview.
+
+    pg_trgm ships with the postgres contrib modules (the compose image has
+    them); without it suggestions still work, scanning the previews.
+    """
+    cur.execute("SAVEPOINT document_search_index")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_document_preview_trgm
+            ON documents USING gin (content_preview gin_trgm_ops)
+        """)
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT document_search_index")
+        logger.warning("pg_trgm unavailable, /search/suggestions scans content_preview: %s", e)
+    cur.execute("RELEASE SAVEPOINT document_search_index")
+
+# Column triggers follow a column by number, not name, so reembed.py reruns
+# this after swapping embedding columns
+DOCUMENT_CHANGES_UPDATE_TRIGGER = """
+    CREATE OR REPLACE TRIGGER documents_changes_update
+        AFTER UPDATE OF embedding, service_id, content, summary, key_facts ON documents
+        FOR EACH ROW
+        WHEN (OLD.embedding IS DISTINCT FROM NEW.embedding
+              OR OLD.service_id IS DISTINCT FROM NEW.service_id
+              OR OLD.content IS DISTINCT FROM NEW.content
+              OR OLD.summary IS DISTINCT FROM NEW.summary
+              OR OLD.key_facts IS DISTINCT FROM NEW.key_facts)
+        EXECUTE FUNCTION log_document_changes();
+"""
+
+def create_document_change_log(cur):
+    """document_changes records which documents changed, for RETRIEVAL_BACKEND=memory.
+
+    Statement-level triggers keep bulk COPY cheap. Updates are logged per row,
+    and only when a column the index or its cached metadata serves changes
+    (Postgres allows no transition table on an UPDATE OF trigger), so preview
+    backfills and reembed.py filling embedding_next log nothing. A NULL document_id means
+    every worker must rebuild (TRUNCATE, reembed.py --switch). Snapshot
+    builds and /queue/maintenance prune it.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS document_changes (
+            seq BIGSERIAL PRIMARY KEY,
+            document_id INTEGER,
+            xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_document_changes_xid ON document_changes(xid);
+
+        CREATE OR REPLACE FUNCTION log_document_changes()
+        RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                INSERT INTO document_changes (document_id) VALUES (NULL);
+            ELSIF TG_LEVEL = 'ROW' THEN
+                INSERT INTO document_changes (document_id) VALUES (NEW.id);
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO document_changes (document_id) SELECT id FROM old_rows;
+            ELSE
+                INSERT INTO document_changes (document_id) SELECT id FROM new_rows;
+            END IF;
+            PERFORM pg_notify('document_changes', TG_OP);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE TRIGGER documents_changes_insert
+            AFTER INSERT ON documents REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+        CREATE OR REPLACE TRIGGER documents_changes_delete
+            AFTER DELETE ON documents REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+        CREATE OR REPLACE TRIGGER documents_changes_truncate
+            AFTER TRUNCATE ON documents
+            FOR EACH STATEMENT EXECUTE FUNCTION log_document_changes();
+    """)
+    cur.execute(DOCUMENT_CHANGES_UPDATE_TRIGGER)
+
+# Column order shared by the partitions, the legacy table and the archive
+QUEUE_BOOKING_TABLE_COLUMNS = (
+    "id, queue_number, citizen_name, citizen_phone, citizen_email, service_id, "
+    "booking_date, booking_time, status, notes, created_at, updated_at"
+)
+LEGACY_QUEUE_INDEXES = ("idx_queue_service", "idx_queue_date", "idx_queue_status",
+                        "idx_queue_number", "idx_queue_citizen_phone")
+
+# /queue/book in one statement: validate the service, reject a duplicate phone
+# booking, number the queue, insert and return the QueueBookingResponse row.
+# Returns no row for an unknown service; a duplicate raises unique_violation
+# with the existing queue number as DETAIL.
+BOOK_QUEUE_FUNCTION = """
+CREATE OR REPLACE FUNCTION book_queue_v1(
+    p_citizen_name VARCHAR, p_citizen_phone VARCHAR, p_citizen_email VARCHAR,
+    p_service_id INTEGER, p_booking_date DATE, p_booking_time TIME, p_notes TEXT
+) RETURNS TABLE (
+    id INTEGER, queue_number VARCHAR, citizen_name VARCHAR, citizen_phone VARCHAR,
+    citizen_email VARCHAR, province_name VARCHAR, district_name VARCHAR, service_name VARCHAR,
+    booking_date DATE, booking_time TIME, status VARCHAR, notes TEXT, created_at TIMESTAMP,
+    province_id INTEGER, district_id INTEGER, service_id INTEGER
+) AS $$
+#variable_conflict use_column
+DECLARE
+    v_taken VARCHAR;
+    v_prefix VARCHAR;
+    v_number INTEGER;
+BEGIN
+    PERFORM 1 FROM services s WHERE s.id = p_service_id;
+    IF NOT FOUND THEN
+        RETURN;
+    END IF;
+
+    -- The duplicate check and the numbering must see each other's bookings, so
+    -- concurrent bookings of one service and day take turns until commit
+    PERFORM pg_advisory_xact_lock(p_service_id, p_booking_date - DATE '2000-01-01');
+
+    SELECT qb.queue_number INTO v_taken FROM queue_bookings qb
+    WHERE qb.citizen_phone = p_citizen_phone AND qb.service_id = p_service_id
+      AND qb.booking_date = p_booking_date AND qb.status <> 'cancelled'
+    LIMIT 1;
+    IF v_taken IS NOT NULL THEN
+        RAISE EXCEPTION 'duplicate_booking' USING ERRCODE = 'unique_violation', DETAIL = v_taken;
+    END IF;
+
+    -- Queue numbers read Q{service:03d}{MMDD}{n:03d}, n from the day's counter.
+    -- Counting the day's bookings instead would hand out a number again after
+    -- a delete while a later booking still holds it.
+    v_prefix := 'Q' || LPAD(p_service_id::text, GREATEST(3, length(p_service_id::text)), '0')
+        || TO_CHAR(p_booking_date, 'MMDD');
+    UPDATE queue_counters c SET last_number = c.last_number + 1
+    WHERE c.service_id = p_service_id AND c.booking_date = p_booking_date
+    RETURNING c.last_number INTO v_number;
+    IF NOT FOUND THEN
+        -- First booking of the day since the counter was created or pruned
+        SELECT COALESCE(MAX(substr(qb.queue_number, length(v_prefix) + 1)::integer), 0) + 1 INTO v_number
+        FROM queue_bookings qb
+        WHERE qb.service_id = p_service_id AND qb.booking_date = p_booking_date
+          AND qb.queue_number ~ ('^' || v_prefix || '[0-9]+$');
+        INSERT INTO queue_counters (service_id, booking_date, last_number)
+        VALUES (p_service_id, p_booking_date, v_number);
+    END IF;
+
+    RETURN QUERY
+    WITH booked AS (
+        INSERT INTO queue_bookings AS qb (
+            queue_number, citizen_name, citizen_phone, citizen_email,
+            service_id, booking_date, booking_time, status, notes
+        ) VALUES (
+            v_prefix || LPAD(v_number::text, GREATEST(3, length(v_number::text)), '0'),
+            p_citizen_name, p_citizen_phone, p_citizen_email,
+            p_service_id, p_booking_date, p_booking_time, 'pending', p_notes
+        )
+        RETURNING qb.*
+    )
+    SELECT b.id, b.queue_number, b.citizen_name, b.citizen_phone, b.citizen_email,
+           p.name, d.name, s.name,
+           b.booking_date, b.booking_time, b.status, b.notes, b.created_at,
+           p.id, d.id, s.id
+    FROM booked b
+    JOIN services s ON b.service_id = s.id
+    JOIN districts d ON s.district_id = d.id
+    JOIN provinces p ON d.province_id = p.id;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+def month_start(day: date, offset: int = 0) -> date:
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+def queue_partition_name(day: date) -> str:
+    return f"queue_bookings_{day:%Y_%m}"
+
+def create_queue_bookings(cur):
+    """Create the month-partitioned queue_bookings, migrating a plain legacy table in place"""
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('queue_bookings')")
+    row = cur.fetchone()
+    legacy = row is not None and row[0] == "r"
+    if legacy:
+        cur.execute("LOCK TABLE queue_bookings IN ACCESS EXCLUSIVE MODE")
+        # Index names are schema-wide, free them for the partitioned table
+        for index in LEGACY_QUEUE_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {index}")
+        cur.execute("ALTER TABLE queue_bookings RENAME TO queue_bookings_legacy")
+        cur.execute("ALTER INDEX IF EXISTS queue_bookings_pkey RENAME TO queue_bookings_legacy_pkey")
+        cur.execute("ALTER INDEX IF EXISTS queue_bookings_queue_number_key RENAME TO queue_bookings_legacy_queue_number_key")
+
+    # The id sequence outlives the legacy table, so migrated ids keep counting up.
+    # Queue numbers repeat every year (Q{service}{MMDD}{n}), hence unique per day.
+    cur.execute("""
+        CREATE SEQUENCE IF NOT EXISTS queue_bookings_id_seq;
+
+        CREATE TABLE IF NOT EXISTS queue_bookings (
+            id INTEGER NOT NULL DEFAULT nextval('queue_bookings_id_seq'),
+            queue_number VARCHAR(20) NOT NULL,
+            citizen_name VARCHAR(100) NOT NULL,
+            citizen_phone VARCHAR(20) NOT NULL,
+            citizen_email VARCHAR(100),
+            service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
+            booking_date DATE NOT NULL,
+            booking_time TIME NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending',
+            notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, booking_date),
+            UNIQUE (queue_number, booking_date)
+        ) PARTITION BY RANGE (booking_date);
+
+        ALTER SEQUENCE queue_bookings_id_seq OWNED BY queue_bookings.id;
+
+        -- Catches dates outside the monthly partitions until one is created for them
+        CREATE TABLE IF NOT EXISTS queue_bookings_default PARTITION OF queue_bookings DEFAULT;
+
+        -- Last queue number handed out per service and day, see book_queue_v1
+        CREATE TABLE IF NOT EXISTS queue_counters (
+            service_id INTEGER REFERENCES services(id) ON DELETE CASCADE,
+            booking_date DATE NOT NULL,
+            last_number INTEGER NOT NULL,
+            PRIMARY KEY (service_id, booking_date)
+        );
+
+        CREATE TABLE IF NOT EXISTS queue_bookings_archive (
+            LIKE queue_bookings,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id)
+        );
+    """)
+    # Booking lists, statistics and queue numbering all filter on service and day
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_service_date_status ON queue_bookings(service_id, booking_date, status);")
+    # Duplicate-booking check in /queue/book; also serves plain phone lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_phone_service_date ON queue_bookings(citizen_phone, service_id, booking_date);")
+    # Backs the duplicate check: two requests that both pass it cannot both insert
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_queue_live_booking
+        ON queue_bookings(citizen_phone, service_id, booking_date) WHERE status <> 'cancelled';
+    """)
+    cur.execute("DROP INDEX IF EXISTS idx_queue_citizen_phone;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_queue_archive_service_date ON queue_bookings_archive(service_id, booking_date);")
+    cur.execute(BOOK_QUEUE_FUNCTION)
+
+    create_upcoming_queue_partitions(cur)
+
+    if legacy:
+        # One INSERT ... SELECT while the ACCESS EXCLUSIVE lock from above is
+        # held, so bookings are blocked for the whole copy: run migrate in a
+        # quiet window on large tables
+        cur.execute("SELECT DISTINCT date_trunc('month', booking_date)::date FROM queue_bookings_legacy")
+        for (month,) in cur.fetchall():
+            create_queue_partition(cur, month)
+        cur.execute(f"""
+            INSERT INTO queue_bookings ({QUEUE_BOOKING_TABLE_COLUMNS})
+            SELECT {QUEUE_BOOKING_TABLE_COLUMNS} FROM queue_bookings_legacy
+        """)
+        logger.info("migrated %s bookings into partitioned queue_bookings", cur.rowcount)
+
+        cur.execute("""
+            SELECT DISTINCT v.relname FROM pg_depend dep
+            JOIN pg_rewrite r ON r.oid = dep.objid
+            JOIN pg_class v ON v.oid = r.ev_class
+            WHERE dep.refobjid = 'queue_bookings_legacy'::regclass AND v.oid <> dep.refobjid
+        """)
+        views = [name for (name,) in cur.fetchall()]
+        if views:
+            # Views are bound to the renamed table; dropping it would drop them too
+            logger.warning("queue_bookings_legacy kept because views %s still read it; "
+                           "recreate them on queue_bookings and drop it", ", ".join(views))
+        else:
+            cur.execute("DROP TABLE queue_bookings_legacy")
+
+def create_queue_partition(cur, day: date) -> Optional[str]:
+    """Create the monthly partition holding day; returns its name when it was created"""
+    start, end = month_start(day), month_start(day, 1)
+    name = queue_partition_name(start)
+    # Concurrent migrate/maintenance runs create it once
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (name,))
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    if cur.fetchone()[0]:
+        return None
+
+    # Bookings that fell into the default partition move into their month first,
+    # otherwise ATTACH would reject the overlap
+    cur.execute(f"CREATE TABLE {name} (LIKE queue_bookings INCLUDING DEFAULTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM queue_bookings_default
+            WHERE booking_date >= %s AND booking_date < %s
+            RETURNING {QUEUE_BOOKING_TABLE_COLUMNS}
+        )
+        INSERT INTO {name} ({QUEUE_BOOKING_TABLE_COLUMNS})
+        SELECT {QUEUE_BOOKING_TABLE_COLUMNS} FROM moved
+    """, (start, end))
+    cur.execute(f"ALTER TABLE queue_bookings ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    return name
+
+def default_partition_months(cur) -> List[dict]:
+    """Months with bookings in queue_bookings_default, i.e. with no partition of their own.
+
+    Creating such a month's partition later has to move those rows while it
+    holds ACCESS EXCLUSIVE on the default partition, so they should not pile up.
+    """
+    cur.execute("""
+        SELECT date_trunc('month', booking_date)::date AS month, COUNT(*) FROM queue_bookings_default
+        GROUP BY 1 ORDER BY 1
+    """)
+    return [{"month": month.isoformat(), "bookings": bookings} for month, bookings in cur.fetchall()]
+
+def create_upcoming_queue_partitions(cur) -> List[str]:
+    today = date.today()
+    created = [create_queue_partition(cur, month_start(today, offset))
+               for offset in range(QUEUE_PARTITION_MONTHS_AHEAD + 1)]
+    return [name for name in created if name]
+
+def archive_queue_bookings(cur, retention_days: int = QUEUE_RETENTION_DAYS):
+    """Move finished bookings older than retention_days to the archive.
+
+    Month partitions left empty by the move are detached and dropped; months
+    still holding pending/confirmed bookings stay attached.
+    """
+    cutoff = date.today() - timedelta(days=retention_days)
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM queue_bookings
+            WHERE booking_date < %s AND status IN ('completed', 'cancelled')
+            RETURNING {QUEUE_BOOKING_TABLE_COLUMNS}
+        )
+        INSERT INTO queue_bookings_archive ({QUEUE_BOOKING_TABLE_COLUMNS})
+        SELECT {QUEUE_BOOKING_TABLE_COLUMNS} FROM moved
+    """, (cutoff,))
+    archived = cur.rowcount
+
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'queue_bookings'::regclass
+          AND c.relname ~ '^queue_bookings_[0-9]{4}_[0-9]{2}$'
+        ORDER BY c.relname
+    """)
+    dropped = []
+    for (name,) in cur.fetchall():
+        month = date(int(name[-7:-3]), int(name[-2:]), 1)
+        if month_start(month, 1) > cutoff:
+            continue
+        cur.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+        if cur.fetchone()[0]:
+            continue
+        cur.execute(f"ALTER TABLE queue_bookings DETACH PARTITION {name}")
+        cur.execute(f"DROP TABLE {name}")
+        dropped.append(name)
+    return archived, dropped
+
+def check_embedding_dimension(cur, column: str = "embedding"):
+    """Fail fast when EMBEDDING_DIM disagrees with the stored vector(N) column"""
+    cur.execute("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = 'documents'::regclass AND attname = %s AND NOT attisdropped
+    """, (column,))
+    row = cur.fetchone()
+    if row and row[0] > 0 and row[0] != EMBEDDING_DIM:
+        raise RuntimeError(
+            f"documents.{column} is vector({row[0]}) but EMBEDDING_DIM={EMBEDDING_DIM}; "
+            "re-embed the documents before changing the embedding dimension"
+        )
+
+VECTOR_INDEX_SUFFIXES = {"halfvec": "halfvec", "binary": "bit"}
+
+def vector_index_statements(storage: str, column: str = "embedding", dim: int = EMBEDDING_DIM,
+                            index_prefix: str = "idx_document_embedding", concurrently: bool = False) -> List[str]:
+    """DDL for the quantized ANN index of a storage mode.
+
+    The full-precision column stays the source of truth for rescoring; only the
+    index holds the halfvec/bit copy, so existing rows migrate by building it.
+    """
+    create = "CREATE INDEX CONCURRENTLY IF NOT EXISTS" if concurrently else "CREATE INDEX IF NOT EXISTS"
+    if storage == "halfvec":
+        return [f"""
+            {create} {index_prefix}_halfvec ON documents
+            USING hnsw (({column}::halfvec({dim})) halfvec_cosine_ops)
+        """]
+    if storage == "binary":
+        return [f"""
+            {create} {index_prefix}_bit ON documents
+            USING hnsw ((binary_quantize({column})::bit({dim})) bit_hamming_ops)
+        """]
+    return []
+
+def vector_search_sql(storage: str, where: str = "", column: str = "embedding", dim: int = EMBEDDING_DIM) -> str:
+    """Nearest-document query for a storage mode.
+
+    Quantized modes pick ``%(candidates)s`` rows from the ANN index and rescore
+    them against the full-precision column, so the final order is exact.
+    Expects ``%(q)s`` (query vector) and ``%(limit)s`` parameters.
+    """
+    select = f"""
+        SELECT d.id, d.content_preview, d.content_length, d.summary, d.key_facts,
+               s.name AS service, dt.name AS district, p.name AS province,
+               d.{column} <=> %(q)s::vector AS similarity,
+               s.id as service_id, dt.id as district_id, p.id as province_id
+    """
+    joins = """
+        JOIN services s ON d.service_id = s.id
+        JOIN districts dt ON s.district_id = dt.id
+        JOIN provinces p ON dt.province_id = p.id
+    """
+    if storage == "vector":
+        return f"""
+            {select}
+            FROM documents d
+            {joins}
+            {f"WHERE {where}" if where else ""}
+            ORDER BY similarity ASC LIMIT %(limit)s
+        """
+
+    if storage == "halfvec":
+        coarse = f"{column}::halfvec({dim}) <=> %(q)s::halfvec({dim})"
+    else:
+        coarse = f"binary_quantize({column})::bit({dim}) <~> binary_quantize(%(q)s::vector)"
+    return f"""
+        {select}
+        FROM (
+            SELECT id FROM documents d
+            {f"WHERE {where}" if where else ""}
+            ORDER BY {coarse} LIMIT %(candidates)s
+        ) c
+        JOIN documents d ON d.id = c.id
+        {joins}
+        ORDER BY similarity ASC LIMIT %(limit)s
+    """
+
+def execute_vector_search(cur, query_embedding, storage: str = VECTOR_STORAGE, limit: int = 1,
+                          candidates: int = VECTOR_RESCORE_CANDIDATES, service_id: Optional[int] = None):
+    """Run the nearest-document query on an open cursor"""
+    candidates = max(candidates, limit)
+    if storage != "vector":
+        # HNSW returns at most ef_search rows, so it must cover the candidate pool
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (min(max(candidates, 40), 1000),))
+    where = "d.service_id = %(service_id)s" if service_id else ""
+    cur.execute(vector_search_sql(storage, where=where), {
+        "q": query_embedding,
+        "limit": limit,
+        "candidates": candidates,
+        "service_id": service_id,
+    })
+    return cur.fetchall()
+
+def fetch_rows(cur) -> List[dict]:
+    """Map the remaining rows of a plain tuple cursor to dicts.
+
+    Cheaper than RealDictCursor, and the dicts go straight to orjson.
+    """
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+def get_service_by_id(service_id: int, readonly: bool = False):
     """Get service info and related IDs by service_id"""
-    with get_db_connection() as conn:
+    with get_db_connection(readonly=readonly) as conn:
         cur = conn.cursor(cursor_factory=RealDictCursor)
         cur.execute("""
             SELECT s.id as service_id, d.id as district_id, p.id as province_id,
@@ -206,131 +1218,919 @@ def get_service_by_id(service_id: int):
             raise HTTPException(status_code=404, detail=f"ไม่พบบริการ ID: {service_id}")
         return result
 
-def generate_queue_number(service_id: int, booking_date: date) -> str:
-    """Generate unique queue number"""
-    with get_db_connection() as conn:
-        cur = conn.cursor()
-        # Count bookings for the same service and date
-        cur.execute("""
-            SELECT COUNT(*) FROM queue_bookings 
-            WHERE service_id = %s AND booking_date = %s
-        """, (service_id, booking_date))
-        count = cur.fetchone()[0]
-        return f"Q{service_id:03d}{booking_date.strftime('%m%d')}{count+1:03d}"
-
-def extract_text_from_pdf(pdf_file: UploadFile) -> str:
+def extract_text_from_pdf(pdf_file: UploadFile):
+    """Text of every page, and the page count"""
     try:
-        pdf_content = pdf_file.file.read()
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+        with stage("pdf_extract"):
+            pdf_content = pdf_file.file.read()
+            pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
 
-        text = ""
-        for page in pdf_reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+            text = ""
+            for page in pdf_reader.pages:
+                page_text = page.extract_text()
+                if page_text:
+                    text += page_text + "\n"
 
         if not text.strip():
             raise HTTPException(status_code=400, detail="ไม่สามารถดึงข้อความจากไฟล์ PDF ได้")
 
-        return text.strip()
+        return text.strip(), len(pdf_reader.pages)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"เกิดข้อผิดพลาดในการอ่านไฟล์ PDF: {str(e)}")
 
+class RemoteEmbedder:
+    """Embedder backed by an inference worker's /embed endpoint"""
+
+    def __init__(self, url: str = INFERENCE_URL, dim: int = EMBEDDING_DIM):
+        import httpx
+        self.dim = dim
+        # Keep-alive connections to the inference worker
+        self._client = httpx.Client(base_url=url, timeout=60)
+
+    def encode(self, sentences, **kwargs):
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        response = self._client.post("/embed", json={"texts": texts})
+        response.raise_for_status()
+        vectors = np.asarray(response.json()["embeddings"], dtype=np.float32)
+        return vectors[0] if isinstance(sentences, str) else vectors
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+def load_embedder(model_name: str = EMBEDDING_MODEL, backend: str = EMBEDDING_BACKEND,
+                  model_file: Optional[str] = EMBEDDING_MODEL_FILE, quantize: str = EMBEDDING_QUANTIZE,
+                  threads: int = EMBEDDING_THREADS, max_seq_length: int = EMBEDDING_MAX_SEQ_LENGTH,
+                  dim: int = EMBEDDING_DIM):
+    """Build the sentence embedder for the configured inference runtime.
+
+    backend is ``torch`` or ``onnx``; model_file picks a specific ONNX export
+    (e.g. ``onnx/model_qint8_avx512_vnni.onnx`` for int8), and quantize=int8
+    applies dynamic int8 quantization to the torch model instead. ``remote``
+    delegates to the inference worker at INFERENCE_URL.
+    """
+    if backend == "remote":
+        return RemoteEmbedder(INFERENCE_URL, dim)
+    if backend not in ("torch", "onnx"):
+        raise RuntimeError(f"EMBEDDING_BACKEND must be 'torch', 'onnx' or 'remote', got {backend!r}")
+
+    model_kwargs = {}
+    if model_file:
+        model_kwargs["file_name"] = model_file
+    if threads:
+        if backend == "torch":
+            import torch
+            torch.set_num_threads(threads)
+        else:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            model_kwargs["session_options"] = session_options
+
+    model = SentenceTransformer(model_name, backend=backend, model_kwargs=model_kwargs or None, truncate_dim=dim)
+
+    if quantize == "int8":
+        if backend != "torch":
+            raise RuntimeError("EMBEDDING_QUANTIZE=int8 applies to the torch backend; use a quantized ONNX model file instead")
+        import torch
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif quantize:
+        raise RuntimeError(f"Unsupported EMBEDDING_QUANTIZE: {quantize!r}")
+
+    if max_seq_length:
+        model.max_seq_length = max_seq_length
+
+    if model.get_sentence_embedding_dimension() != dim:
+        raise RuntimeError(
+            f"{model_name} produces {model.get_sentence_embedding_dimension()}-dim embeddings, "
+            f"cannot serve EMBEDDING_DIM={dim}"
+        )
+    return model
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """Load the configured embedder once, on first use"""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = load_embedder()
+    return _embedder
+
 def create_embedding(text: str):
     try:
-        embedding = embedder.encode(text)
+        with stage("embed"):
+            embedding = get_embedder().encode(text)
         return embedding.tolist()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้าง embedding: {str(e)}")
 
-def save_document_to_db(content: str, service_info: dict):
+def save_document_to_db(content: str, service_info: dict, background_tasks: Optional[BackgroundTasks] = None,
+                        page_count: Optional[int] = None):
+    """Insert a document; with SUMMARY_MODE on, its summary is written after the response.
+
+    content_preview and content_length are filled by the set_document_preview trigger.
+    """
     try:
         embedding = create_embedding(content)
         with get_db_connection() as conn:
             cur = conn.cursor()
             cur.execute("""
-                INSERT INTO documents (content, service_id, embedding)
-                VALUES (%s, %s, %s)
+                INSERT INTO documents (content, service_id, embedding, summary_status, page_count)
+                VALUES (%s, %s, %s, %s, %s)
                 RETURNING id
-            """, (content, service_info['service_id'], embedding))
+            """, (content, service_info['service_id'], embedding, None if SUMMARY_MODE == "off" else "pending", page_count))
             doc_id = cur.fetchone()[0]
+            invalidate_semantic_cache_near(cur, embedding, service_info['service_id'])
             conn.commit()
-            return doc_id
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการบันทึกเอกสาร: {str(e)}")
+    # Without background_tasks the document stays pending for the backfill endpoint
+    if SUMMARY_MODE != "off" and background_tasks is not None:
+        background_tasks.add_task(summarize_document, doc_id, content)
+    return doc_id
+
+# Lines carrying amounts, durations, hours, contacts or required documents
+KEY_FACT_PATTERN = re.compile(r"\d|บาท|ค่าธรรมเนียม|ระยะเวลา|เวลา|โทร|ติดต่อ|เอกสาร|สถานที่|ชั้น")
+LIST_MARKER_PATTERN = re.compile(r"^\s*(?:[-•*]|\d+[.)])\s*")
+
+def extractive_summary(content: str):
+    """Title plus descriptive lines as the summary, fact-bearing lines as key facts"""
+    lines = [LIST_MARKER_PATTERN.sub("", line).strip() for line in content.splitlines()]
+    lines = [line for line in lines if line]
+    if not lines:
+        return "", []
+
+    key_facts = []
+    summary = lines[0]
+    for line in lines[1:]:
+        if KEY_FACT_PATTERN.search(line):
+            if line not in key_facts and len(key_facts) < SUMMARY_MAX_FACTS:
+                key_facts.append(line)
+        elif len(summary) + len(line) + 1 <= SUMMARY_MAX_CHARS:
+            summary += " " + line
+    return summary[:SUMMARY_MAX_CHARS], key_facts
+
+def llm_summary(content: str):
+    """Ask the LLM for a short summary and key facts as JSON"""
+    response = ollama.chat(model=LLM_MODEL, format="json", keep_alive=LLM_KEEP_ALIVE,
+                           options={"num_ctx": LLM_NUM_CTX}, messages=[
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"""
+        สรุปเอกสารต่อไปนี้เป็นภาษาไทยอย่างกระชับไม่เกิน {SUMMARY_MAX_CHARS} ตัวอักษร
+        และดึงข้อเท็จจริงสำคัญ (ค่าธรรมเนียม ระยะเวลา เอกสารที่ต้องใช้ สถานที่ เวลาทำการ ช่องทางติดต่อ) ไม่เกิน {SUMMARY_MAX_FACTS} ข้อ
+        ตอบเป็น JSON รูปแบบ {{"summary": "...", "key_facts": ["..."]}} เท่านั้น
+
+        เอกสาร:
+        {content[:4000]}
+        """}
+    ])
+    parsed = json.loads(response["message"]["content"])
+    key_facts = [str(fact).strip() for fact in parsed.get("key_facts", []) if str(fact).strip()]
+    return str(parsed.get("summary", "")).strip()[:SUMMARY_MAX_CHARS], key_facts[:SUMMARY_MAX_FACTS]
+
+def summarize_document(doc_id: int, content: str, mode: str = SUMMARY_MODE):
+    """Compute and store a document's summary; an LLM failure falls back to extractive"""
+    status = "done"
+    with stage("summarize"):
+        if mode == "llm" and LLM_BACKEND != "stub":
+            try:
+                summary, key_facts = llm_summary(content)
+            except Exception as e:
+                logger.warning("LLM summary of document %s failed, using extractive: %s", doc_id, e)
+                summary, key_facts = extractive_summary(content)
+        else:
+            summary, key_facts = extractive_summary(content)
+    if not summary:
+        status = "failed"
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE documents SET summary = %s, key_facts = %s, summary_status = %s WHERE id = %s
+        """, (summary or None, Json(key_facts), status, doc_id))
+        # Memory-index workers drop their cached metadata through document_changes;
+        # cached answers only depend on the summary when the prompt is built from it
+        if PROMPT_CONTEXT_SOURCE == "summary":
+            invalidate_semantic_cache_for_documents(cur, [doc_id])
+        conn.commit()
+
+def summarize_pending_documents(limit: int, mode: str = SUMMARY_MODE) -> int:
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, content FROM documents
+            WHERE summary_status IS DISTINCT FROM 'done'
+            ORDER BY id LIMIT %s
+        """, (limit,))
+        pending = cur.fetchall()
+    for doc_id, content in pending:
+        try:
+            summarize_document(doc_id, content, mode)
+        except Exception as e:
+            logger.warning("summary of document %s failed: %s", doc_id, e)
+    return len(pending)
+
+def document_context(doc: dict) -> str:
+    """Prompt text for one retrieved document"""
+    if PROMPT_CONTEXT_SOURCE == "summary" and doc.get('summary'):
+        facts = "\n".join(f"- {fact}" for fact in doc.get('key_facts') or [])
+        return f"{doc['summary']}\n{facts}" if facts else doc['summary']
+    return doc['content_preview']
+
+RETRIEVALS = Counter("retrievals_total", "Document retrievals by the backend that served them", ["backend"])
+
+VECTOR_INDEX_DOCUMENTS_SQL = """
+    SELECT d.id, d.content_preview, d.content_length, d.summary, d.key_facts,
+           s.name AS service, dt.name AS district, p.name AS province,
+           s.id as service_id, dt.id as district_id, p.id as province_id
+    FROM documents d
+    JOIN services s ON d.service_id = s.id
+    JOIN districts dt ON s.district_id = dt.id
+    JOIN provinces p ON dt.province_id = p.id
+    WHERE d.id = ANY(%s)
+"""
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def dot_rows(matrix, query, chunk: int = 16384):
+    """matrix @ query in float32; float16 rows are upcast a chunk at a time"""
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    scores = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), chunk):
+        scores[start:start + chunk] = matrix[start:start + chunk].astype(np.float32) @ query
+    return scores
+
+def best_scores(ids, scores, limit: int):
+    if len(scores) > limit:
+        keep = np.argpartition(-scores, limit - 1)[:limit]
+        ids, scores = ids[keep], scores[keep]
+    return ids, scores
+
+class VectorIndexState:
+    """Immutable view of the index: snapshot rows still alive plus the documents changed since.
+
+    Searches read whichever state is current while the sync thread builds the next one.
+    """
 
-def search_similar_documents(query: str):
-    try:
-        query_embedding = create_embedding(query)
+    def __init__(self, generation: str, ids, service_ids, vectors, alive, delta: dict):
+        self.generation = generation
+        self.ids = ids
+        self.service_ids = service_ids
+        self.vectors = vectors
+        self.alive = alive
+        self.delta = delta
+        self.delta_ids = np.fromiter(delta, dtype=np.int64, count=len(delta))
+        self.delta_service_ids = np.array([service for service, _ in delta.values()], dtype=np.int64)
+        self.delta_vectors = (np.stack([vector for _, vector in delta.values()]) if delta
+                              else np.empty((0, vectors.shape[1]), dtype=np.float32))
+
+    def with_changes(self, doc_ids: List[int], rows) -> "VectorIndexState":
+        """Next state after doc_ids changed; rows are their current (id, service_id, embedding)"""
+        alive = self.alive
+        wanted = np.asarray(doc_ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, wanted)
+        inside = positions < len(self.ids)
+        positions = positions[inside][self.ids[positions[inside]] == wanted[inside]]
+        if len(positions):
+            alive = alive.copy()
+            alive[positions] = False
+        changed = set(doc_ids)
+        delta = {doc_id: value for doc_id, value in self.delta.items() if doc_id not in changed}
+        for doc_id, service_id, embedding in rows:
+            delta[doc_id] = (service_id, normalize_rows(np.asarray(embedding, dtype=np.float32)))
+        return VectorIndexState(self.generation, self.ids, self.service_ids, self.vectors, alive, delta)
+
+    def top_k(self, query, limit: int, service_id: Optional[int] = None):
+        """Ids and cosine similarities of the limit nearest documents, best first"""
+        found_ids, found_scores = [], []
+        if len(self.ids):
+            if service_id:
+                rows = np.flatnonzero(self.alive & (self.service_ids == service_id))
+                scores = dot_rows(self.vectors[rows], query)
+                ids = self.ids[rows]
+            else:
+                scores = dot_rows(self.vectors, query)
+                scores[~self.alive] = -np.inf
+                ids = self.ids
+            ids, scores = best_scores(ids, scores, limit)
+            found_ids.append(ids)
+            found_scores.append(scores)
+        if len(self.delta_ids):
+            rows = self.delta_service_ids == service_id if service_id else slice(None)
+            ids, scores = best_scores(self.delta_ids[rows], self.delta_vectors[rows] @ query, limit)
+            found_ids.append(ids)
+            found_scores.append(scores)
+        if not found_ids:
+            return [], []
+        ids = np.concatenate(found_ids)
+        scores = np.concatenate(found_scores)
+        order = np.argsort(-scores)[:limit]
+        order = order[np.isfinite(scores[order])]
+        return [int(doc_id) for doc_id in ids[order]], [float(score) for score in scores[order]]
+
+class MemoryVectorIndex:
+    """RETRIEVAL_BACKEND=memory: every embedding in a memory-mapped matrix, searched with NumPy.
+
+    A snapshot generation is written to VECTOR_INDEX_DIR by whichever worker
+    gets the build lock; the others map the same files read-only. Each worker
+    folds later document_changes into an in-process delta and reloads when a
+    newer generation appears. Document text and names come from a small LRU
+    cache, so most searches make no database round-trip.
+    """
+
+    def __init__(self, directory: str, dtype: str = VECTOR_INDEX_DTYPE, dim: int = EMBEDDING_DIM):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.dim = dim
+        self.state = None
+        # Database snapshot whose committed changes the state already reflects
+        self.seen_snapshot = None
+        self._metadata = OrderedDict()
+        self._metadata_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.state is not None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def read_manifest(self) -> Optional[dict]:
+        try:
+            with open(self._path("manifest.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def compatible(self, manifest: dict) -> bool:
+        # /queue/maintenance prunes changes after a day, so older snapshots cannot be caught up.
+        # A reembed.py switch can keep the dimension, so the model has to match too.
+        return (manifest["dim"] == self.dim and manifest["dtype"] == self.dtype.name
+                and manifest.get("embedding_model") == EMBEDDING_MODEL
+                and time.time() - manifest["written_at"] < 86400)
+
+    def build_snapshot(self, seen_generation: Optional[str] = None) -> dict:
+        """Write a new generation, unless another worker replaced seen_generation while we waited"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("build.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.read_manifest()
+            if manifest and manifest["generation"] != seen_generation and self.compatible(manifest):
+                return manifest
+
+            started = time.perf_counter()
+            generation = uuid.uuid4().hex[:12]
+            with get_db_connection() as conn:
+                cur = conn.cursor()
+                # Count, rows and the snapshot they were read in, all from one snapshot
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cur.execute("SELECT pg_current_snapshot()::text")
+                snapshot = cur.fetchone()[0]
+                cur.execute("SELECT COUNT(*) FROM documents WHERE embedding IS NOT NULL")
+                count = cur.fetchone()[0]
+
+                ids = np.empty(count, dtype=np.int64)
+                service_ids = np.empty(count, dtype=np.int64)
+                vectors = None
+                if count:
+                    vectors = np.memmap(self._path(f"vectors-{generation}.bin"), dtype=self.dtype,
+                                        mode="w+", shape=(count, self.dim))
+                stream = conn.cursor(name="vector_index_snapshot")
+                stream.execute("""
+                    SELECT id, COALESCE(service_id, 0), embedding::real[] FROM documents
+                    WHERE embedding IS NOT NULL ORDER BY id
+                """)
+                row = 0
+                while True:
+                    batch = stream.fetchmany(2000)
+                    if not batch:
+                        break
+                    end = row + len(batch)
+                    ids[row:end] = [doc_id for doc_id, _, _ in batch]
+                    service_ids[row:end] = [service_id for _, service_id, _ in batch]
+                    vectors[row:end] = normalize_rows(np.array([embedding for _, _, embedding in batch], dtype=np.float32))
+                    row = end
+                stream.close()
+                conn.rollback()
+                if vectors is not None:
+                    vectors.flush()
+                    del vectors
+
+                np.save(self._path(f"ids-{generation}.npy"), ids)
+                np.save(self._path(f"services-{generation}.npy"), service_ids)
+                manifest = {"generation": generation, "count": count, "dim": self.dim, "dtype": self.dtype.name,
+                            "embedding_model": EMBEDDING_MODEL, "snapshot": snapshot, "written_at": time.time()}
+                with open(self._path("manifest.tmp"), "w", encoding="utf-8") as f:
+                    json.dump(manifest, f)
+                os.replace(self._path("manifest.tmp"), self._path("manifest.json"))
+
+                # Every worker reloads this generation on its next poll, so what it covers is no longer needed
+                cur.execute("DELETE FROM document_changes WHERE pg_visible_in_snapshot(xid, %s::pg_snapshot)", (snapshot,))
+                conn.commit()
+
+            # Workers still mapping an old generation keep their view until they reload
+            for name in os.listdir(self.directory):
+                if name.startswith(("vectors-", "ids-", "services-")) and generation not in name:
+                    os.remove(self._path(name))
+            logger.info("vector index snapshot %s: %s documents in %.1fs", generation, count, time.perf_counter() - started)
+            return manifest
+
+    def load(self, manifest: dict):
+        generation = manifest["generation"]
+        count = manifest["count"]
+        ids = np.load(self._path(f"ids-{generation}.npy"))
+        service_ids = np.load(self._path(f"services-{generation}.npy"))
+        if count:
+            vectors = np.memmap(self._path(f"vectors-{generation}.bin"), dtype=self.dtype,
+                                mode="r", shape=(count, self.dim))
+        else:
+            vectors = np.empty((0, self.dim), dtype=self.dtype)
+        self.state = VectorIndexState(generation, ids, service_ids, vectors, np.ones(count, dtype=bool), {})
+        self.seen_snapshot = manifest["snapshot"]
+        with self._metadata_lock:
+            self._metadata.clear()
+
+    def apply_changes(self) -> Optional[int]:
+        """Fold changes committed since seen_snapshot into the state; None when a TRUNCATE needs a new snapshot.
+
+        Visibility rather than seq order decides what is new, so a transaction
+        that commits after a later-numbered one is still picked up.
+        """
         with get_db_connection() as conn:
+            cur = conn.cursor()
+            # Taken first: anything committing in between is applied now and again next time
+            cur.execute("SELECT pg_current_snapshot()::text")
+            snapshot = cur.fetchone()[0]
+            cur.execute("""
+                SELECT document_id FROM document_changes
+                WHERE xid >= pg_snapshot_xmin(%(seen)s::pg_snapshot)
+                  AND NOT pg_visible_in_snapshot(xid, %(seen)s::pg_snapshot)
+            """, {"seen": self.seen_snapshot})
+            changes = [doc_id for (doc_id,) in cur.fetchall()]
+            if None in changes:
+                return None
+            doc_ids = sorted(set(changes))
+            rows = []
+            if doc_ids:
+                cur.execute("""
+                    SELECT id, COALESCE(service_id, 0), embedding::real[] FROM documents
+                    WHERE id = ANY(%s) AND embedding IS NOT NULL
+                """, (doc_ids,))
+                rows = cur.fetchall()
+
+        if doc_ids:
+            self.state = self.state.with_changes(doc_ids, rows)
+            with self._metadata_lock:
+                for doc_id in doc_ids:
+                    self._metadata.pop(doc_id, None)
+        self.seen_snapshot = snapshot
+        return len(doc_ids)
+
+    def sync(self):
+        """Load a newer snapshot if there is one, then apply pending changes"""
+        with self._sync_lock:
+            manifest = self.read_manifest()
+            if manifest is None or not self.compatible(manifest):
+                manifest = self.build_snapshot(manifest["generation"] if manifest else None)
+            if self.state is None or manifest["generation"] != self.state.generation:
+                self.load(manifest)
+            applied = self.apply_changes()
+            if applied is None or len(self.state.delta) > VECTOR_INDEX_REBUILD_DELTA:
+                self.load(self.build_snapshot(self.state.generation))
+                self.apply_changes()
+
+    def run(self):
+        """Sync loop: wakes on NOTIFY document_changes, and every VECTOR_INDEX_POLL_SECONDS regardless"""
+        listener = None
+        while True:
+            try:
+                if listener is None:
+                    # NOTIFY is only delivered on the primary
+                    listener = psycopg2.connect(db_url)
+                    listener.autocommit = True
+                    listener.cursor().execute("LISTEN document_changes")
+                self.sync()
+                if select.select([listener], [], [], VECTOR_INDEX_POLL_SECONDS)[0]:
+                    listener.poll()
+                    listener.notifies.clear()
+            except Exception as e:
+                logger.warning("vector index sync failed: %s", e)
+                if listener is not None:
+                    listener.close()
+                    listener = None
+                time.sleep(VECTOR_INDEX_POLL_SECONDS)
+
+    def documents(self, doc_ids: List[int]) -> dict:
+        """Search-result rows for doc_ids, from the LRU cache or one primary-key query"""
+        found = {}
+        with self._metadata_lock:
+            for doc_id in doc_ids:
+                if doc_id in self._metadata:
+                    self._metadata.move_to_end(doc_id)
+                    found[doc_id] = self._metadata[doc_id]
+        missing = [doc_id for doc_id in doc_ids if doc_id not in found]
+        if missing:
+            # Primary, so a document changed a moment ago is not cached stale from a replica
+            with get_db_connection() as conn:
+                cur = conn.cursor(cursor_factory=RealDictCursor)
+                cur.execute(VECTOR_INDEX_DOCUMENTS_SQL, (missing,))
+                rows = {row['id']: dict(row) for row in cur.fetchall()}
+            with self._metadata_lock:
+                for doc_id, row in rows.items():
+                    self._metadata[doc_id] = row
+                while len(self._metadata) > VECTOR_INDEX_METADATA_CACHE:
+                    self._metadata.popitem(last=False)
+            found.update(rows)
+        return found
+
+    def search(self, query_embedding, limit: int = 1, service_id: Optional[int] = None) -> List[dict]:
+        """Same rows as execute_vector_search; similarity is the cosine distance"""
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        doc_ids, scores = self.state.top_k(query, limit, service_id)
+        documents = self.documents(doc_ids)
+        return [
+            {**documents[doc_id], "similarity": 1.0 - score}
+            for doc_id, score in zip(doc_ids, scores) if doc_id in documents
+        ]
+
+    def status(self) -> dict:
+        state = self.state
+        if state is None:
+            return {"ready": False}
+        return {
+            "ready": True,
+            "generation": state.generation,
+            "snapshot_documents": int(state.alive.sum()),
+            "delta_documents": len(state.delta),
+            "dtype": self.dtype.name,
+            "seen_snapshot": self.seen_snapshot,
+        }
+
+memory_index = MemoryVectorIndex(VECTOR_INDEX_DIR)
+
+def search_documents_by_embedding(query_embedding, limit: int = 1, service_id: Optional[int] = None):
+    if RETRIEVAL_BACKEND == "memory" and memory_index.ready:
+        try:
+            with stage("vector_search"):
+                results = memory_index.search(query_embedding, limit=limit, service_id=service_id)
+            RETRIEVALS.labels("memory").inc()
+            return results
+        except Exception as e:
+            logger.warning("memory vector search failed, using pgvector: %s", e)
+    RETRIEVALS.labels("pgvector").inc()
+    try:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             # ค้นหาในทุกเอกสาร ไม่มีการ filter
-            base_query = """
-                SELECT d.id, d.content, s.name AS service, dt.name AS district, p.name AS province,
-                       d.embedding <=> %s::vector AS similarity,
-                       s.id as service_id, dt.id as district_id, p.id as province_id
-                FROM documents d
-                JOIN services s ON d.service_id = s.id
-                JOIN districts dt ON s.district_id = dt.id
-                JOIN provinces p ON dt.province_id = p.id
-                ORDER BY similarity ASC LIMIT 1
-            """
-            
-            cur.execute(base_query, [query_embedding])
-            results = cur.fetchall()
+            with stage("vector_search"):
+                results = execute_vector_search(cur, query_embedding, limit=limit, service_id=service_id)
             return [dict(result) for result in results]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการค้นหาเอกสาร: {str(e)}")
 
-def generate_answer_with_ollama(question: str, context_documents: List[dict]) -> str:
-    try:
-        context = "\n\n".join([doc['content'][:1000] for doc in context_documents[:3]])
-        prompt = f"""
-        ตอบคำถามต่อไปนี้โดยใช้ข้อมูลจากเอกสารที่เกี่ยวข้อง:
+def search_similar_documents(query: str, limit: int = 1, service_id: Optional[int] = None):
+    return search_documents_by_embedding(create_embedding(query), limit=limit, service_id=service_id)
 
-        คำถาม: {question}
+def generate_stub_answer(question: str, context_documents: List[dict]) -> str:
+    """Deterministic offline stand-in for the LLM, used by benchmarks and tests"""
+    if not context_documents:
+        return "ไม่พบข้อมูลที่เกี่ยวข้อง"
+    return context_documents[0]['content_preview'][:200]
 
-        ข้อมูลอ้างอิง:
-        {context}
+SYSTEM_PROMPT = "คุณเป็นผู้ช่วยตอบคำถามภาษาไทย ตอบด้วยความสุภาพและให้ข้อมูลที่ถูกต้อง ใช้คำว่า 'ครับ' หรือ 'ค่ะ' ตามความเหมาะสม"
+# Fixed for every /query and /chat prompt, so it is always the cached start of the prefix
+ANSWER_SYSTEM_PROMPT = SYSTEM_PROMPT + """
 
-        กรุณาตอบเป็นภาษาไทยและให้ข้อมูลที่ถูกต้องตามเอกสารที่ให้มา หากไม่มีข้อมูลในเอกสาร ให้บอกว่าไม่พบข้อมูลที่เกี่ยวข้อง
-        """
-        response = ollama.chat(model="qwen2.5:3b", messages=[
-            {"role": "system", "content": "คุณเป็นผู้ช่วยตอบคำถามภาษาไทย ตอบด้วยความสุภาพและให้ข้อมูลที่ถูกต้อง ใช้คำว่า 'ครับ' หรือ 'ค่ะ' ตามความเหมาะสม"},
-            {"role": "user", "content": prompt}
-        ])
-        return response["message"]["content"]
+ตอบคำถามโดยใช้ข้อมูลจากเอกสารอ้างอิงที่ให้มา กรุณาตอบเป็นภาษาไทยและให้ข้อมูลที่ถูกต้องตามเอกสาร หากไม่มีข้อมูลในเอกสาร ให้บอกว่าไม่พบข้อมูลที่เกี่ยวข้อง"""
+
+def record_prefill(chunk: dict):
+    """Report the prompt evaluation ollama measured for one request.
+
+    prompt_eval_count only counts tokens that were not reused from the cached
+    prefix, so a steady stable-prefix hit rate shows up as small counts here.
+    """
+    tokens = chunk.get("prompt_eval_count") or 0
+    seconds = (chunk.get("prompt_eval_duration") or 0) / 1e9
+    LLM_PREFILL_TOKENS.observe(tokens)
+    STAGE_LATENCY.labels("llm_prefill").observe(seconds)
+    timings = STAGE_TIMINGS.get()
+    if timings is not None:
+        timings["llm_prefill"] = timings.get("llm_prefill", 0.0) + seconds * 1000
+    prefill = PREFILL_TOKENS.get()
+    if prefill is not None:
+        prefill.append(tokens)
+    logger.debug("llm prefill: %s tokens in %.1f ms", tokens, seconds * 1000)
+
+def stream_ollama_chat(messages: List[dict]):
+    """Yield a chat completion's text chunks as they arrive"""
+    with stage("llm_generate"):
+        started = time.perf_counter()
+        first = True
+        for chunk in ollama.chat(model=LLM_MODEL, messages=messages, stream=True,
+                                 keep_alive=LLM_KEEP_ALIVE, options={"num_ctx": LLM_NUM_CTX}):
+            if first:
+                STAGE_LATENCY.labels("llm_first_token").observe(time.perf_counter() - started)
+                first = False
+            if chunk.get("done"):
+                record_prefill(chunk)
+            yield chunk["message"]["content"]
+
+def ollama_chat(messages: List[dict]) -> str:
+    return "".join(stream_ollama_chat(messages))
+
+def reference_context(context_documents: List[dict]) -> str:
+    """The top three documents as blocks in id order, so the same documents always render the same text"""
+    docs = sorted(context_documents[:3], key=lambda doc: doc["id"])
+    return "\n\n".join(f"[เอกสาร {doc['id']}]\n{document_context(doc)}" for doc in docs)
+
+def answer_prompt(question: str, context_documents: List[dict]) -> str:
+    """Reference documents first and the question last, so only the question differs between askers"""
+    return f"ข้อมูลอ้างอิง:\n{reference_context(context_documents)}\n\nคำถาม: {question}"
+
+def answer_messages(question: str, context_documents: List[dict]) -> List[dict]:
+    return [
+        {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+        {"role": "user", "content": answer_prompt(question, context_documents)}
+    ]
+
+def stream_answer(question: str, context_documents: List[dict]):
+    """Yield the answer in chunks as the LLM produces them"""
+    if LLM_BACKEND == "stub":
+        yield generate_stub_answer(question, context_documents)
+        return
+    try:
+        yield from stream_ollama_chat(answer_messages(question, context_documents))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้างคำตอบ: {str(e)}")
 
+def generate_answer_with_ollama(question: str, context_documents: List[dict]) -> str:
+    return "".join(stream_answer(question, context_documents))
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method, getattr(route, "path", "unmatched"), str(status)
+        ).observe(time.perf_counter() - started)
+
+@app.get("/metrics")
+async def metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Several workers: aggregate the per-process files prometheus_client writes there
+        from prometheus_client import CollectorRegistry, multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+serving_state = {"ready": False}
+
+def warm_up(check_database: bool = True):
+    """Open the DB pools and load the embedder before the worker reports ready.
+
+    Retries with backoff, so a worker started before Postgres or the
+    inference worker becomes ready once they are reachable.
+    """
+    attempt = 0
+    while True:
+        try:
+            started = time.perf_counter()
+            if check_database:
+                with get_db_connection() as conn:
+                    check_embedding_dimension(conn.cursor())
+                for replica in replicas:
+                    replica.usable()
+            get_embedder().encode(["warmup"])
+            serving_state["ready"] = True
+            logger.info("worker ready after %.1fs warmup", time.perf_counter() - started)
+            return
+        except Exception as e:
+            attempt += 1
+            delay = min(2 ** attempt, 30)
+            logger.warning("warmup failed (%s), retrying in %ss", e, delay)
+            time.sleep(delay)
+
+@app.on_event("startup")
+async def start_warmup():
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    if RETRIEVAL_BACKEND == "memory":
+        threading.Thread(target=memory_index.run, name="vector-index", daemon=True).start()
+
+@app.on_event("shutdown")
+async def drain():
+    """Let /query streams whose clients are gone finish, then close the pools"""
+    serving_state["ready"] = False
+    pending = [broadcast.task for broadcast in list(query_streams.values()) if broadcast.task]
+    if pending:
+        await asyncio.wait(pending, timeout=SHUTDOWN_GRACE_SECONDS)
+    query_log.flush()
+    primary_pool.closeall()
+    for replica in replicas:
+        replica.pool.closeall()
+
+@app.get("/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def health_ready():
+    if not serving_state["ready"]:
+        return ORJSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready"}
+
 @app.get("/")
 async def root():
     return {"message": "Document Management System with Queue Booking API v3", "version": "3.0.0"}
 
+def hierarchy_name(name: str, position: str) -> str:
+    name = name.strip()
+    if not name:
+        raise HTTPException(status_code=400, detail=f"ชื่อว่างที่{position}")
+    if len(name) > 100:
+        raise HTTPException(status_code=400, detail=f"ชื่อยาวเกิน 100 ตัวอักษรที่{position}")
+    return name
+
+def hierarchy_rows(provinces: List[ProvinceCreate]) -> List[tuple]:
+    """Flatten nested provinces into stripped (province, district, service) rows.
+
+    Blank or over-long names are rejected with a 400 naming their position,
+    before anything reaches COPY.
+    """
+    rows = []
+    for p, province in enumerate(provinces, start=1):
+        province_name = hierarchy_name(province.name, f"จังหวัดลำดับ {p}")
+        if not province.districts:
+            rows.append((province_name, None, None))
+        for d, district in enumerate(province.districts, start=1):
+            district_name = hierarchy_name(district.name, f"จังหวัดลำดับ {p} อำเภอลำดับ {d}")
+            if not district.services:
+                rows.append((province_name, district_name, None))
+            for s, service in enumerate(district.services, start=1):
+                rows.append((province_name, district_name,
+                             hierarchy_name(service.name, f"จังหวัดลำดับ {p} อำเภอลำดับ {d} บริการลำดับ {s}")))
+    return rows
+
+def import_hierarchy(cur, rows) -> dict:
+    """Upsert validated (province, district, service) rows set-wise on their natural keys.
+
+    Rows are COPY'd into a staging table and each level is inserted with one
+    statement that resolves parent ids by name, so the whole tree costs a
+    handful of round-trips in the caller's transaction. Concurrent imports
+    meet on the unique natural keys (ON CONFLICT DO NOTHING, in key order so
+    they cannot deadlock) rather than a table lock, so CRUD writes are never
+    blocked. A row holds nothing but its
+    key, so an existing row is reported unchanged; nothing is ever updated.
+    Empty district/service names mean the row stops at the level above.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([name or None for name in row])
+    buffer.seek(0)
+
+    cur.execute("""
+        CREATE TEMP TABLE hierarchy_staging (
+            province VARCHAR(100) NOT NULL,
+            district VARCHAR(100),
+            service VARCHAR(100)
+        ) ON COMMIT DROP
+    """)
+    cur.copy_expert("COPY hierarchy_staging (province, district, service) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    cur.execute("""
+        WITH incoming AS (
+            SELECT DISTINCT province AS name FROM hierarchy_staging
+        ), inserted AS (
+            INSERT INTO provinces (name)
+            SELECT name FROM incoming ORDER BY name
+            ON CONFLICT (name) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM incoming)
+    """)
+    provinces = cur.fetchone()
+
+    cur.execute("""
+        WITH incoming AS (
+            SELECT DISTINCT p.id AS province_id, st.district AS name
+            FROM hierarchy_staging st
+            JOIN provinces p ON p.name = st.province
+            WHERE st.district IS NOT NULL
+        ), inserted AS (
+            INSERT INTO districts (name, province_id)
+            SELECT name, province_id FROM incoming ORDER BY province_id, name
+            ON CONFLICT (province_id, name) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM incoming)
+    """)
+    districts = cur.fetchone()
+
+    cur.execute("""
+        WITH incoming AS (
+            SELECT DISTINCT d.id AS district_id, st.service AS name
+            FROM hierarchy_staging st
+            JOIN provinces p ON p.name = st.province
+            JOIN districts d ON d.province_id = p.id AND d.name = st.district
+            WHERE st.service IS NOT NULL
+        ), inserted AS (
+            INSERT INTO services (name, district_id)
+            SELECT name, district_id FROM incoming ORDER BY district_id, name
+            ON CONFLICT (district_id, name) DO NOTHING
+            RETURNING id
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM incoming)
+    """)
+    services = cur.fetchone()
+
+    return {
+        level: {"inserted": inserted, "unchanged": incoming - inserted}
+        for level, (inserted, incoming) in (("provinces", provinces), ("districts", districts), ("services", services))
+    }
+
 @app.post("/provinces/full")
 async def create_province_full(data: ProvinceCreate):
     """
-    Create full province structure
+    Create full province structure; fails if the province already exists
+    (use /provinces/import to merge into existing data)
     """
+    rows = hierarchy_rows([data])
     try:
         with get_db_connection() as conn:
             cur = conn.cursor()
-            cur.execute("INSERT INTO provinces (name) VALUES (%s) RETURNING id", (data.name,))
-            province_id = cur.fetchone()[0]
-
-            for district in data.districts:
-                cur.execute("INSERT INTO districts (name, province_id) VALUES (%s, %s) RETURNING id", (district.name, province_id))
-                district_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO provinces (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING id", (rows[0][0],))
+            created = cur.fetchone()
+            if created is None:
+                raise HTTPException(status_code=409, detail=f"มีจังหวัด {rows[0][0]} อยู่แล้ว")
+            import_hierarchy(cur, rows)
+            conn.commit()
+            return {"id": created[0], "name": data.name}
 
-                for service in district.services:
-                    cur.execute("INSERT INTO services (name, district_id) VALUES (%s, %s) RETURNING id", (service.name, district_id))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้างข้อมูลแบบลำดับชั้น: {str(e)}")
 
+@app.post("/provinces/import")
+async def import_provinces(data: List[ProvinceCreate]):
+    """
+    Bulk import of many province trees in one transaction, merging into what
+    already exists; reports inserted and unchanged rows per level
+    """
+    rows = hierarchy_rows(data)
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            summary = import_hierarchy(cur, rows)
             conn.commit()
-            return {"id": province_id, "name": data.name}
+            return summary
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการนำเข้าข้อมูลแบบลำดับชั้น: {str(e)}")
+
+@app.post("/provinces/import/csv")
+async def import_provinces_csv(file: UploadFile = File(...)):
+    """
+    Bulk import from a CSV with province,district,service columns
+    """
+    try:
+        text = (await file.read()).decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="ไฟล์ CSV ต้องเป็น encoding UTF-8")
 
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or 'province' not in reader.fieldnames:
+        raise HTTPException(status_code=400, detail="ไฟล์ CSV ต้องมีคอลัมน์ province, district, service")
+
+    rows = []
+    for line_number, record in enumerate(reader, start=2):
+        row = tuple((record.get(column) or '').strip() for column in ('province', 'district', 'service'))
+        if not row[0] or (row[2] and not row[1]):
+            raise HTTPException(status_code=400, detail=f"ข้อมูลไม่ครบถ้วนในบรรทัดที่ {line_number}")
+        if any(len(name) > 100 for name in row):
+            raise HTTPException(status_code=400, detail=f"ชื่อยาวเกิน 100 ตัวอักษรในบรรทัดที่ {line_number}")
+        rows.append(row)
+
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            summary = import_hierarchy(cur, rows)
+            conn.commit()
+            return summary
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้างข้อมูลแบบลำดับชั้น: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการนำเข้าข้อมูลแบบลำดับชั้น: {str(e)}")
 
 # Province CRUD operations
 @app.post("/provinces")
@@ -348,17 +2148,17 @@ async def create_province(name: str):
 @app.get("/provinces")
 async def list_provinces():
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
             cur.execute("SELECT id, name FROM provinces ORDER BY name")
-            return cur.fetchall()
+            return ORJSONResponse(fetch_rows(cur))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/provinces/{province_id}")
 async def get_province(province_id: int):
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             cur.execute("SELECT id, name FROM provinces WHERE id = %s", (province_id,))
             result = cur.fetchone()
@@ -384,6 +2184,7 @@ async def delete_province(province_id: int):
     try:
         with get_db_connection() as conn:
             cur = conn.cursor()
+            delete_service_documents(cur, "district_id IN (SELECT id FROM districts WHERE province_id = %s)", (province_id,))
             cur.execute("DELETE FROM provinces WHERE id = %s", (province_id,))
             conn.commit()
             return {"message": "ลบจังหวัดสำเร็จ"}
@@ -394,8 +2195,8 @@ async def delete_province(province_id: int):
 @app.get("/districts")
 async def list_districts(province_id: Optional[int] = None):
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
             if province_id:
                 cur.execute("""
                     SELECT d.id, d.name, d.province_id, p.name as province_name
@@ -411,7 +2212,7 @@ async def list_districts(province_id: Optional[int] = None):
                     JOIN provinces p ON d.province_id = p.id
                     ORDER BY p.name, d.name
                 """)
-            return cur.fetchall()
+            return ORJSONResponse(fetch_rows(cur))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -430,7 +2231,7 @@ async def create_district(name: str, province_id: int):
 @app.get("/districts/{district_id}")
 async def get_district(district_id: int):
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             cur.execute("""
                 SELECT d.id, d.name, d.province_id, p.name as province_name
@@ -464,6 +2265,7 @@ async def delete_district(district_id: int):
     try:
         with get_db_connection() as conn:
             cur = conn.cursor()
+            delete_service_documents(cur, "district_id = %s", (district_id,))
             cur.execute("DELETE FROM districts WHERE id = %s", (district_id,))
             conn.commit()
             return {"message": "ลบเขต/อำเภอสำเร็จ"}
@@ -474,8 +2276,8 @@ async def delete_district(district_id: int):
 @app.get("/services")
 async def list_services(district_id: Optional[int] = None, province_id: Optional[int] = None):
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
             
             query = """
                 SELECT s.id, s.name, s.district_id, d.name as district_name, 
@@ -500,7 +2302,7 @@ async def list_services(district_id: Optional[int] = None, province_id: Optional
             query += " ORDER BY p.name, d.name, s.name"
             
             cur.execute(query, params)
-            return cur.fetchall()
+            return ORJSONResponse(fetch_rows(cur))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -519,7 +2321,7 @@ async def create_service(name: str, district_id: int):
 @app.get("/services/{service_id}")
 async def get_service(service_id: int):
     try:
-        service_info = get_service_by_id(service_id)
+        service_info = get_service_by_id(service_id, readonly=True)
         return service_info
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -543,6 +2345,7 @@ async def delete_service(service_id: int):
     try:
         with get_db_connection() as conn:
             cur = conn.cursor()
+            delete_service_documents(cur, "id = %s", (service_id,))
             cur.execute("DELETE FROM services WHERE id = %s", (service_id,))
             conn.commit()
             return {"message": "ลบบริการสำเร็จ"}
@@ -552,6 +2355,7 @@ async def delete_service(service_id: int):
 # Document upload endpoints
 @app.post("/upload/pdf", response_model=DocumentResponse)
 async def upload_pdf_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     service_id: int = Form(...)
 ):
@@ -559,8 +2363,8 @@ async def upload_pdf_document(
         raise HTTPException(status_code=400, detail="กรุณาอัปโหลดไฟล์ PDF เท่านั้น")
     
     service_info = get_service_by_id(service_id)
-    text_content = extract_text_from_pdf(file)
-    doc_id = save_document_to_db(text_content, service_info)
+    text_content, page_count = extract_text_from_pdf(file)
+    doc_id = save_document_to_db(text_content, service_info, background_tasks, page_count=page_count)
     
     return DocumentResponse(
         id=doc_id, 
@@ -575,6 +2379,7 @@ async def upload_pdf_document(
 
 @app.post("/upload/text", response_model=DocumentResponse)
 async def upload_text_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     service_id: int = Form(...)
 ):
@@ -590,7 +2395,7 @@ async def upload_text_document(
         raise HTTPException(status_code=400, detail="ไฟล์ text ต้องเป็น encoding UTF-8")
     
     service_info = get_service_by_id(service_id)
-    doc_id = save_document_to_db(text_content, service_info)
+    doc_id = save_document_to_db(text_content, service_info, background_tasks)
     
     return DocumentResponse(
         id=doc_id, 
@@ -604,12 +2409,12 @@ async def upload_text_document(
     )
 
 @app.post("/add/text", response_model=DocumentResponse)
-async def add_text_directly(text_input: TextInput):
+async def add_text_directly(text_input: TextInput, background_tasks: BackgroundTasks):
     if not text_input.text.strip():
         raise HTTPException(status_code=400, detail="กรุณาใส่ข้อความ")
     
     service_info = get_service_by_id(text_input.service_id)
-    doc_id = save_document_to_db(text_input.text, service_info)
+    doc_id = save_document_to_db(text_input.text, service_info, background_tasks)
     
     return DocumentResponse(
         id=doc_id, 
@@ -623,77 +2428,877 @@ async def add_text_directly(text_input: TextInput):
     )
 
 # Query endpoint
+RELEVANT_DOCUMENT_FIELDS = ("id", "content_preview", "content_length", "province", "district", "service",
+                            "similarity_score", "province_id", "district_id", "service_id")
+
+def relevant_document(doc: dict) -> dict:
+    return {
+        "id": doc['id'],
+        "content_preview": doc['content_preview'][:200] + "..." if doc['content_length'] > 200 else doc['content_preview'],
+        "content_length": doc['content_length'],
+        "province": doc['province'],
+        "district": doc['district'],
+        "service": doc['service'],
+        "similarity_score": float(doc['similarity']),
+        "province_id": doc['province_id'],
+        "district_id": doc['district_id'],
+        "service_id": doc['service_id']
+    }
+
+SEMANTIC_CACHE_EVENTS = Counter("semantic_cache_total", "Semantic answer cache lookups and maintenance", ["outcome"])
+
+def lookup_semantic_cache(embedding, service_id: Optional[int] = None,
+                          max_age_hours: float = SEMANTIC_CACHE_TTL_HOURS) -> Optional[dict]:
+    """Closest entry younger than max_age_hours within SEMANTIC_CACHE_MAX_DISTANCE under the same scope"""
+    with get_db_connection(readonly=True) as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute("""
+            SELECT id, answer, documents, doc_ids, embedding <=> %(q)s::vector AS distance
+            FROM semantic_cache
+            WHERE scope_key = %(scope)s
+              AND created_at > CURRENT_TIMESTAMP - make_interval(secs => %(ttl)s)
+            ORDER BY embedding <=> %(q)s::vector
+            LIMIT 1
+        """, {"q": embedding, "scope": service_id or 0, "ttl": max_age_hours * 3600})
+        row = cur.fetchone()
+    if row is None or row["distance"] > SEMANTIC_CACHE_MAX_DISTANCE:
+        return None
+    return dict(row)
+
+def cached_answer(embedding, service_id: Optional[int] = None):
+    """Returns (cache entry, None) on a hit, else (None, retrieved documents).
+
+    A sample of hits is checked against fresh retrieval; a hit whose documents
+    no longer match counts as a false hit, is dropped and answered fresh.
+    """
+    entry = None
+    if SEMANTIC_CACHE:
+        try:
+            entry = lookup_semantic_cache(embedding, service_id)
+        except Exception as e:
+            SEMANTIC_CACHE_EVENTS.labels("error").inc()
+            logger.warning("semantic cache lookup failed: %s", e)
+    if entry is not None and random.random() >= SEMANTIC_CACHE_VERIFY_RATE:
+        record_cache_hit(entry["id"])
+        return entry, None
+
+    similar_docs = search_documents_by_embedding(embedding, service_id=service_id)
+    if entry is None:
+        SEMANTIC_CACHE_EVENTS.labels("miss").inc()
+        return None, similar_docs
+    if [doc["id"] for doc in similar_docs] == list(entry["doc_ids"]):
+        SEMANTIC_CACHE_EVENTS.labels("verified").inc()
+        record_cache_hit(entry["id"])
+        return entry, None
+    mark_false_hit(entry["id"])
+    return None, similar_docs
+
+def record_cache_hit(entry_id: int):
+    SEMANTIC_CACHE_EVENTS.labels("hit").inc()
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE semantic_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP WHERE id = %s
+            """, (entry_id,))
+            conn.commit()
+    except Exception as e:
+        logger.warning("semantic cache hit not recorded: %s", e)
+
+def mark_false_hit(entry_id: int) -> bool:
+    """Count a wrong cached answer and stop serving it"""
+    SEMANTIC_CACHE_EVENTS.labels("false_hit").inc()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM semantic_cache WHERE id = %s", (entry_id,))
+        conn.commit()
+        return cur.rowcount > 0
+
+def store_semantic_cache(question: str, embedding, service_id: Optional[int], similar_docs: List[dict],
+                         relevant_docs: List[dict], answer: str) -> Optional[int]:
+    if not SEMANTIC_CACHE:
+        return None
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO semantic_cache (scope_key, question, embedding, answer, documents, doc_ids, top_distance)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            """, (service_id or 0, question, embedding, answer, Json(relevant_docs),
+                  [doc["id"] for doc in similar_docs], max(float(doc["similarity"]) for doc in similar_docs)))
+            entry_id = cur.fetchone()[0]
+            # Expired entries are never served; clear them out now and then
+            if entry_id % 100 == 0:
+                cur.execute("""
+                    DELETE FROM semantic_cache
+                    WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                """, (SEMANTIC_CACHE_TTL_HOURS * 3600,))
+            conn.commit()
+        SEMANTIC_CACHE_EVENTS.labels("store").inc()
+        return entry_id
+    except Exception as e:
+        SEMANTIC_CACHE_EVENTS.labels("error").inc()
+        logger.warning("semantic cache store failed: %s", e)
+        return None
+
+def invalidate_semantic_cache_near(cur, embedding, service_id: int):
+    """Drop entries a new document would have out-ranked, in the caller's transaction"""
+    cur.execute("""
+        DELETE FROM semantic_cache
+        WHERE scope_key IN (0, %s) AND (embedding <=> %s::vector) < top_distance
+    """, (service_id, embedding))
+    if cur.rowcount:
+        SEMANTIC_CACHE_EVENTS.labels("invalidated").inc(cur.rowcount)
+
+def invalidate_semantic_cache_for_documents(cur, document_ids: List[int]):
+    """Drop entries whose answer was built from any of document_ids"""
+    cur.execute("DELETE FROM semantic_cache WHERE doc_ids && %s::integer[]", (document_ids,))
+    if cur.rowcount:
+        SEMANTIC_CACHE_EVENTS.labels("invalidated").inc(cur.rowcount)
+
+def delete_service_documents(cur, service_filter: str, params):
+    """Delete the documents of the services matching service_filter ahead of the
+    ON DELETE CASCADE, so the cached answers citing them can be dropped too"""
+    cur.execute(f"""
+        DELETE FROM documents
+        WHERE service_id IN (SELECT id FROM services WHERE {service_filter})
+        RETURNING id
+    """, params)
+    document_ids = [row[0] for row in cur.fetchall()]
+    if document_ids:
+        invalidate_semantic_cache_for_documents(cur, document_ids)
+
+@app.post("/cache/{entry_id}/false-hit")
+async def report_false_hit(entry_id: int):
+    """Feedback that a cached answer did not fit the question"""
+    try:
+        removed = mark_false_hit(entry_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการบันทึกผลแคช: {str(e)}")
+    if not removed:
+        raise HTTPException(status_code=404, detail="ไม่พบรายการในแคช")
+    return {"message": "ลบคำตอบที่ไม่ถูกต้องออกจากแคชแล้ว"}
+
+@app.get("/cache/stats")
+async def semantic_cache_stats():
+    try:
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits,
+                       COUNT(*) FILTER (WHERE hits > 0) AS entries_hit,
+                       MIN(created_at) AS oldest_entry
+                FROM semantic_cache
+            """)
+            stats = fetch_rows(cur)[0]
+        stats.update({
+            "enabled": SEMANTIC_CACHE,
+            "max_distance": SEMANTIC_CACHE_MAX_DISTANCE,
+            "verify_rate": SEMANTIC_CACHE_VERIFY_RATE,
+            "ttl_hours": SEMANTIC_CACHE_TTL_HOURS,
+        })
+        return stats
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงสถิติแคช: {str(e)}")
+
+@app.delete("/cache")
+async def clear_semantic_cache():
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM semantic_cache")
+            conn.commit()
+            return {"message": "ล้างแคชคำตอบสำเร็จ", "removed": cur.rowcount}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการล้างแคช: {str(e)}")
+
+QUERY_COALESCED = Counter("query_coalesced_total", "Requests that joined an identical in-flight query", ["endpoint"])
+
+def normalize_question(question: str) -> str:
+    """Questions differing only in case, spacing or trailing punctuation normalize alike"""
+    return " ".join(question.split()).lower().rstrip("?？!. ")
+
+def coalesce_key(query_request: QueryRequest):
+    return normalize_question(query_request.question), query_request.service_id
+
+class SingleFlight:
+    """Run one computation per key at a time and hand its result to every caller that asked meanwhile"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self._calls
+
+    async def run(self, key, func, *args):
+        task = self._calls.get(key)
+        if task is not None:
+            QUERY_COALESCED.labels(self.name).inc()
+        else:
+            # A detached task, so the leader giving up (disconnect, shutdown)
+            # leaves the computation, and its followers, running like anyone else
+            task = asyncio.ensure_future(run_in_threadpool(func, *args))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        del self._calls[key]
+        if not task.cancelled():
+            # Mark retrieved so a flight nobody waited for does not log a warning
+            task.exception()
+
+class StreamBroadcast:
+    """Fan one producer thread's events out to every subscriber.
+
+    Subscribers that join late first get the events already published, so a
+    coalesced stream still starts from the beginning.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.events = []
+        self.queues = []
+        self.done = False
+        self.task = None
+
+    def publish(self, event: dict):
+        self.loop.call_soon_threadsafe(self._publish, event)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _publish(self, event: dict):
+        self.events.append(event)
+        for queue in self.queues:
+            queue.put_nowait(event)
+
+    def _close(self):
+        self.done = True
+        for queue in self.queues:
+            queue.put_nowait(None)
+
+    async def subscribe(self):
+        queue = asyncio.Queue()
+        for event in self.events:
+            queue.put_nowait(event)
+        if self.done:
+            queue.put_nowait(None)
+        else:
+            self.queues.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            if queue in self.queues:
+                self.queues.remove(queue)
+
+query_flight = SingleFlight("query")
+query_streams = {}
+
+QUERY_LOG_EVENTS = Counter("query_log_entries_total", "Query log entries by outcome", ["outcome"])
+
+class QueryLog:
+    """Buffered query_log writer: record() only appends, a background thread inserts in batches"""
+
+    def __init__(self, batch_size: int = QUERY_LOG_BATCH_SIZE, flush_seconds: float = QUERY_LOG_FLUSH_SECONDS,
+                 max_pending: int = QUERY_LOG_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, endpoint: str, question: str, service_id: Optional[int], latency_ms: dict,
+               doc_ids: List[int], cached: Optional[bool], coalesced: bool = False,
+               prefill_tokens: Optional[List[int]] = None):
+        if not QUERY_LOG:
+            return
+        entry = (datetime.now(), endpoint, normalize_question(question), service_id or 0,
+                 cached, coalesced, Json({name: round(ms, 2) for name, ms in latency_ms.items()}), doc_ids,
+                 sum(prefill_tokens) if prefill_tokens else None)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                QUERY_LOG_EVENTS.labels("dropped").inc()
+                return
+            self._pending.append(entry)
+            pending = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="query-log", daemon=True)
+                self._thread.start()
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered so far; a failed batch is dropped rather than retried forever"""
+        while True:
+            with self._lock:
+                batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+            if not batch:
+                return
+            try:
+                with get_db_connection() as conn:
+                    cur = conn.cursor()
+                    execute_values(cur, """
+                        INSERT INTO query_log (logged_at, endpoint, question, scope_key, cached, coalesced, latency_ms, doc_ids, prefill_tokens)
+                        VALUES %s
+                    """, batch, page_size=self.batch_size)
+                    conn.commit()
+                QUERY_LOG_EVENTS.labels("written").inc(len(batch))
+            except Exception as e:
+                QUERY_LOG_EVENTS.labels("failed").inc(len(batch))
+                logger.warning("query log batch of %s lost: %s", len(batch), e)
+                return
+
+query_log = QueryLog()
+
+def query_embedding(question: str):
+    """Embedding of question, taken from question_embeddings when the prewarm job stored it"""
+    try:
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT embedding::real[] FROM question_embeddings WHERE question = %s",
+                        (normalize_question(question),))
+            row = cur.fetchone()
+        if row is not None:
+            return row[0]
+    except Exception as e:
+        logger.warning("question embedding lookup failed: %s", e)
+    return create_embedding(question)
+
+def answer_query(question: str, service_id: Optional[int] = None) -> QueryResponse:
+    """Answer from the semantic cache, or retrieve, generate and cache"""
+    embedding = query_embedding(question)
+    cached, similar_docs = cached_answer(embedding, service_id)
+    if cached is not None:
+        return QueryResponse(answer=cached["answer"], relevant_documents=cached["documents"],
+                             cached=True, cache_entry_id=cached["id"])
+
+    if not similar_docs:
+        return QueryResponse(answer="ไม่พบเอกสารที่เกี่ยวข้อง", relevant_documents=[])
+    answer = generate_answer_with_ollama(question, similar_docs)
+    relevant_docs = [relevant_document(doc) for doc in similar_docs]
+    return QueryResponse(answer=answer, relevant_documents=relevant_docs,
+                         cache_entry_id=store_semantic_cache(question, embedding, service_id, similar_docs, relevant_docs, answer))
+
+def produce_query_stream(question: str, service_id: Optional[int], broadcast: StreamBroadcast):
+    """Worker-thread side of /query/stream"""
+    timings = {}
+    STAGE_TIMINGS.set(timings)
+    prefill_tokens = []
+    PREFILL_TOKENS.set(prefill_tokens)
+    started = time.perf_counter()
+    try:
+        embedding = query_embedding(question)
+        cached, similar_docs = cached_answer(embedding, service_id)
+        if cached is not None:
+            broadcast.publish({"type": "documents", "relevant_documents": cached["documents"]})
+            broadcast.publish({"type": "token", "content": cached["answer"]})
+            broadcast.publish({"type": "done", "answer": cached["answer"], "cached": True, "cache_entry_id": cached["id"]})
+            query_log.record("stream", question, service_id, {**timings, "total": (time.perf_counter() - started) * 1000},
+                             [doc["id"] for doc in cached["documents"]], True)
+            return
+
+        relevant_docs = [relevant_document(doc) for doc in similar_docs]
+        broadcast.publish({"type": "documents", "relevant_documents": relevant_docs})
+        entry_id = None
+        if not similar_docs:
+            answer = "ไม่พบเอกสารที่เกี่ยวข้อง"
+        else:
+            parts = []
+            for part in stream_answer(question, similar_docs):
+                parts.append(part)
+                broadcast.publish({"type": "token", "content": part})
+            answer = "".join(parts)
+            entry_id = store_semantic_cache(question, embedding, service_id, similar_docs, relevant_docs, answer)
+        broadcast.publish({"type": "done", "answer": answer, "cached": False, "cache_entry_id": entry_id})
+        query_log.record("stream", question, service_id, {**timings, "total": (time.perf_counter() - started) * 1000},
+                         [doc["id"] for doc in similar_docs], False, prefill_tokens=prefill_tokens)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        broadcast.publish({"type": "error", "detail": detail})
+    finally:
+        broadcast.close()
+
 @app.post("/query", response_model=QueryResponse)
 async def query_documents(query_request: QueryRequest):
     if not query_request.question.strip():
         raise HTTPException(status_code=400, detail="กรุณาใส่คำถาม")
     
-    # ค้นหาในทุกเอกสาร ไม่มีการ filter
-    similar_docs = search_similar_documents(query_request.question)
-    
-    if not similar_docs:
-        return QueryResponse(
-            answer="ไม่พบเอกสารที่เกี่ยวข้อง", 
-            relevant_documents=[]
-        )
-    
-    answer = generate_answer_with_ollama(query_request.question, similar_docs)
-    
-    relevant_docs = []
-    
-    for doc in similar_docs:
-        relevant_docs.append({
-            "id": doc['id'],
-            "content_preview": doc['content'][:200] + "..." if len(doc['content']) > 200 else doc['content'],
-            "province": doc['province'],
-            "district": doc['district'],
-            "service": doc['service'],
-            "similarity_score": float(doc['similarity']),
-            "province_id": doc['province_id'],
-            "district_id": doc['district_id'],
-            "service_id": doc['service_id']
-        })
-    
-    return QueryResponse(
-        answer=answer, 
-        relevant_documents=relevant_docs
+    if query_request.fields:
+        keep = parse_fields(",".join(query_request.fields), RELEVANT_DOCUMENT_FIELDS, RELEVANT_DOCUMENT_FIELDS)
+
+    # Identical questions already being answered share that computation
+    key = coalesce_key(query_request)
+    coalesced = query_flight.in_flight(key)
+    timings = {}
+    STAGE_TIMINGS.set(timings)
+    prefill_tokens = []
+    PREFILL_TOKENS.set(prefill_tokens)
+    started = time.perf_counter()
+    response = await query_flight.run(key, answer_query, query_request.question, query_request.service_id)
+    query_log.record("query", query_request.question, query_request.service_id,
+                     {**timings, "total": (time.perf_counter() - started) * 1000},
+                     [doc["id"] for doc in response.relevant_documents], response.cached, coalesced,
+                     prefill_tokens=prefill_tokens)
+    if query_request.fields:
+        # The shared response may be going to other callers too, so project a copy
+        response = response.model_copy(update={"relevant_documents": [
+            {key: doc[key] for key in keep if key in doc} for doc in response.relevant_documents
+        ]})
+    return response
+
+@app.post("/query/stream")
+async def query_documents_stream(query_request: QueryRequest):
+    """Answer as NDJSON events: documents, then tokens, then done (or error)"""
+    if not query_request.question.strip():
+        raise HTTPException(status_code=400, detail="กรุณาใส่คำถาม")
+
+    key = coalesce_key(query_request)
+    broadcast = query_streams.get(key)
+    if broadcast is None:
+        broadcast = StreamBroadcast(asyncio.get_running_loop())
+        query_streams[key] = broadcast
+
+        def finished(_):
+            if query_streams.get(key) is broadcast:
+                del query_streams[key]
+
+        broadcast.task = asyncio.ensure_future(run_in_threadpool(
+            produce_query_stream, query_request.question, query_request.service_id, broadcast
+        ))
+        broadcast.task.add_done_callback(finished)
+    else:
+        QUERY_COALESCED.labels("stream").inc()
+        # The producer logs the shared answer; this only counts the question
+        query_log.record("stream", query_request.question, query_request.service_id, {}, [], None, coalesced=True)
+
+    async def events():
+        async for event in broadcast.subscribe():
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+# Conversation sessions for /chat
+class ChatSession:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        # Ollama history for the current topic. Turns are only appended, so the
+        # next request shares its prompt prefix with the previous one and the
+        # loaded model reuses that part of its KV cache instead of re-prefilling.
+        self.messages = []
+        self.topic_question = None
+        self.topic_embedding = None
+        self.documents = []
+        self.touched = time.monotonic()
+        # Turns of one session run one at a time so their history does not interleave
+        self.lock = asyncio.Lock()
+
+    def start_topic(self, question: str, embedding, documents: List[dict]):
+        self.topic_question = question
+        self.topic_embedding = embedding
+        self.documents = documents
+        self.messages = [{"role": "system", "content": ANSWER_SYSTEM_PROMPT}]
+
+    def record_turn(self, messages: List[dict], answer: str):
+        messages = messages + [{"role": "assistant", "content": answer}]
+        # Keep the turn that carries the reference documents plus the latest ones
+        head, tail = messages[:3], messages[3:]
+        self.messages = head + tail[-2 * (CHAT_MAX_TURNS - 1):] if CHAT_MAX_TURNS > 1 else head
+
+class SessionStore:
+    """In-process chat sessions with an idle TTL and an LRU cap"""
+
+    def __init__(self, ttl: float = CHAT_SESSION_TTL_SECONDS, max_sessions: int = CHAT_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: Optional[str]) -> ChatSession:
+        """Return the live session, or a new one when it is unknown or expired"""
+        now = time.monotonic()
+        with self._lock:
+            # Least recently used first, so expired sessions sit at the front
+            while self._sessions:
+                oldest = next(iter(self._sessions.values()))
+                if now - oldest.touched < self.ttl:
+                    break
+                self._sessions.popitem(last=False)
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = ChatSession(uuid.uuid4().hex)
+                self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            session.touched = now
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return session
+
+    def discard(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+chat_sessions = SessionStore()
+
+CHAT_TURNS = Counter("chat_turns_total", "Chat turns by how their context was obtained", ["kind"])
+
+# Thai openers and references that only make sense after an earlier question
+FOLLOW_UP_PREFIXES = ("แล้ว", "และ", "ส่วน", "ถ้า", "งั้น", "อีก", "ต่อ")
+FOLLOW_UP_MARKERS = ("ดังกล่าว", "ที่ว่า", "อันนี้", "อันนั้น", "เรื่องนี้", "เรื่องนั้น", "ที่นั่น", "ที่นี่")
+FOLLOW_UP_MAX_CHARS = 12
+
+def refers_back(question: str) -> bool:
+    """Only meaningful about the current topic: a back-reference, or too short to stand alone"""
+    compact = re.sub(r"\s+", "", question)
+    return any(marker in compact for marker in FOLLOW_UP_MARKERS) or len(compact) <= FOLLOW_UP_MAX_CHARS
+
+def is_follow_up(question: str) -> bool:
+    return re.sub(r"\s+", "", question).startswith(FOLLOW_UP_PREFIXES) or refers_back(question)
+
+def cosine_similarity(a, b) -> float:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    denominator = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(a @ b) / denominator if denominator else 0.0
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(chat_request: ChatRequest):
+    question = chat_request.question.strip()
+    if not question:
+        raise HTTPException(status_code=400, detail="กรุณาใส่คำถาม")
+
+    session = chat_sessions.get(chat_request.session_id)
+    timings = {}
+    STAGE_TIMINGS.set(timings)
+    prefill_tokens = []
+    PREFILL_TOKENS.set(prefill_tokens)
+    async with session.lock:
+        response = await run_in_threadpool(chat_turn, session, question)
+    if prefill_tokens:
+        response.prefill_tokens = sum(prefill_tokens)
+        response.prefill_ms = round(timings.get("llm_prefill", 0.0), 2)
+        logger.info("chat %s: prefill %s tokens in %.1f ms (reused_context=%s)", session.session_id,
+                    response.prefill_tokens, response.prefill_ms, response.reused_context)
+    return response
+
+def chat_turn(session: ChatSession, question: str) -> ChatResponse:
+    # Follow-ups are made standalone by anchoring them to the topic's question,
+    # which is enough for retrieval and costs no LLM call
+    follow_up = session.topic_question is not None and is_follow_up(question)
+    standalone = f"{session.topic_question} {question}" if follow_up else question
+
+    # A back-reference has nothing to search for on its own, so it is neither
+    # embedded nor retrieved; other follow-ups keep the topic while they stay close to it
+    embedding = None if follow_up and refers_back(question) else create_embedding(standalone)
+
+    if follow_up and (embedding is None or cosine_similarity(embedding, session.topic_embedding) >= CHAT_TOPIC_SIMILARITY):
+        kind = "followup_reused"
+        docs = session.documents
+    else:
+        docs = search_documents_by_embedding(embedding)
+        if not docs:
+            CHAT_TURNS.labels("no_documents").inc()
+            return ChatResponse(session_id=session.session_id, answer="ไม่พบเอกสารที่เกี่ยวข้อง",
+                                standalone_question=standalone, reused_context=False, relevant_documents=[])
+        if [doc['id'] for doc in docs] == [doc['id'] for doc in session.documents]:
+            # Same documents as the running topic, keep its history and prefix
+            kind = "same_documents"
+        else:
+            kind = "followup_retrieved" if follow_up else "new_topic"
+            session.start_topic(standalone, embedding, docs)
+
+    reused = kind in ("followup_reused", "same_documents")
+    content = question if reused else answer_prompt(standalone, docs)
+    messages = session.messages + [{"role": "user", "content": content}]
+
+    if LLM_BACKEND == "stub":
+        answer = generate_stub_answer(standalone, docs)
+    else:
+        try:
+            answer = ollama_chat(messages)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้างคำตอบ: {str(e)}")
+
+    session.record_turn(messages, answer)
+    CHAT_TURNS.labels(kind).inc()
+
+    return ChatResponse(
+        session_id=session.session_id,
+        answer=answer,
+        standalone_question=standalone,
+        reused_context=reused,
+        relevant_documents=[relevant_document(doc) for doc in docs]
     )
 
+@app.delete("/chat/{session_id}")
+async def end_chat(session_id: str):
+    if not chat_sessions.discard(session_id):
+        raise HTTPException(status_code=404, detail="ไม่พบเซสชันการสนทนา")
+    return {"message": "ลบเซสชันการสนทนาสำเร็จ"}
+
+
 # Queue booking endpoints
+BOOKING_GUARD = Counter("booking_guard_total", "Booking requests rejected or replayed before the insert", ["outcome"])
+
+class TokenBucketLimiter:
+    """Per-key token buckets in process memory, least recently used keys evicted first"""
+
+    def __init__(self, capacity: float, refill_per_second: float, max_keys: int = 100000):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str) -> float:
+        """Take one token; returns 0 when allowed, otherwise seconds until a token is free"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.refill_per_second
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, key: str):
+        """Give back the token acquire() took, for a request another limit then rejected"""
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(self.capacity, tokens + 1), updated)
+
+phone_limiter = TokenBucketLimiter(BOOKING_PHONE_BURST, BOOKING_PHONE_PER_HOUR / 3600)
+ip_limiter = TokenBucketLimiter(BOOKING_IP_BURST, BOOKING_IP_PER_MINUTE / 60)
+
+def enforce_booking_rate_limits(citizen_phone: str, client_ip: str):
+    if not BOOKING_RATE_LIMIT:
+        return
+    taken = []
+    for outcome, limiter, key in (("rate_limited_ip", ip_limiter, client_ip),
+                                  ("rate_limited_phone", phone_limiter, citizen_phone)):
+        wait = limiter.acquire(key)
+        if wait:
+            # A rejected request costs nothing, so a phone-limited retry keeps the caller's IP budget
+            for taken_limiter, taken_key in taken:
+                taken_limiter.refund(taken_key)
+            BOOKING_GUARD.labels(outcome).inc()
+            raise HTTPException(
+                status_code=429,
+                detail="มีการจองคิวถี่เกินไป กรุณาลองใหม่ภายหลัง",
+                headers={"Retry-After": str(int(wait) + 1)}
+            )
+        taken.append((limiter, key))
+
+def is_live_booking_conflict(error: psycopg2.IntegrityError) -> bool:
+    """uq_queue_live_booking was violated; partitions report their own index name, so match the key"""
+    return "(citizen_phone, service_id, booking_date)" in (error.diag.message_detail or "")
+
+def claim_idempotency_key(key: str, request_hash: str):
+    """Reserve key for this request; returns None when reserved, else the stored (request_hash, response)"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        # Take over keys left pending by a request that died mid-booking
+        cur.execute("""
+            INSERT INTO booking_idempotency (key, request_hash) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET created_at = CURRENT_TIMESTAMP
+            WHERE booking_idempotency.response IS NULL
+              AND booking_idempotency.request_hash = EXCLUDED.request_hash
+              AND booking_idempotency.created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            RETURNING key
+        """, (key, request_hash, IDEMPOTENCY_PENDING_SECONDS))
+        if cur.fetchone() is not None:
+            conn.commit()
+            return None
+        cur.execute("SELECT request_hash, response FROM booking_idempotency WHERE key = %s", (key,))
+        row = cur.fetchone()
+        conn.commit()
+    # Released between the two statements, treat it like one still in progress
+    return row if row is not None else (request_hash, None)
+
+def replay_idempotent_booking(stored, request_hash: str):
+    stored_hash, response = stored
+    if stored_hash != request_hash:
+        BOOKING_GUARD.labels("idempotency_mismatch").inc()
+        raise HTTPException(status_code=422, detail="Idempotency-Key นี้ถูกใช้กับข้อมูลการจองอื่นแล้ว")
+    if response is None:
+        BOOKING_GUARD.labels("idempotency_in_progress").inc()
+        raise HTTPException(status_code=409, detail="คำขอจองคิวนี้กำลังดำเนินการอยู่", headers={"Retry-After": "1"})
+    BOOKING_GUARD.labels("replayed").inc()
+    return ORJSONResponse(response, headers={"Idempotent-Replayed": "true"})
+
+def store_idempotent_response(key: str, response: QueueBookingResponse):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE booking_idempotency SET response = %s WHERE key = %s",
+                    (Json(response.model_dump(mode="json")), key))
+        conn.commit()
+
+def release_idempotency_key(key: str):
+    """Forget a key whose booking failed, so the client can retry with it"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM booking_idempotency WHERE key = %s AND response IS NULL", (key,))
+        conn.commit()
+
 @app.post("/queue/book", response_model=QueueBookingResponse)
-async def book_queue(booking: QueueBookingCreate):
+async def book_queue(
+    booking: QueueBookingCreate,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Book a queue; retries carrying the same Idempotency-Key get the original booking back"""
+    request_hash = None
+    if idempotency_key:
+        if len(idempotency_key) > 100:
+            raise HTTPException(status_code=400, detail="Idempotency-Key ยาวเกิน 100 ตัวอักษร")
+        request_hash = hashlib.sha256(booking.model_dump_json().encode()).hexdigest()
+        stored = claim_idempotency_key(idempotency_key, request_hash)
+        if stored is not None:
+            return replay_idempotent_booking(stored, request_hash)
+
+    try:
+        # request.client is the X-Forwarded-For client when the peer is in FORWARDED_ALLOW_IPS
+        enforce_booking_rate_limits(booking.citizen_phone, request.client.host if request.client else "unknown")
+        response = create_booking(booking)
+    except Exception:
+        if idempotency_key:
+            release_idempotency_key(idempotency_key)
+        raise
+
+    if idempotency_key:
+        store_idempotent_response(idempotency_key, response)
+    return response
+
+def create_booking(booking: QueueBookingCreate) -> QueueBookingResponse:
+    """Validate, number, insert and return the booking in one prepared round-trip"""
     try:
-        service_info = get_service_by_id(booking.service_id)
-        queue_number = generate_queue_number(service_info['service_id'], booking.booking_date)
-        
         with get_db_connection() as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("""
-                INSERT INTO queue_bookings (
-                    queue_number, citizen_name, citizen_phone, citizen_email,
-                    service_id, booking_date, booking_time, status, notes
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING *
-            """, (
-                queue_number, booking.citizen_name, booking.citizen_phone, booking.citizen_email,
-                service_info['service_id'], booking.booking_date, booking.booking_time, 
-                QueueStatus.PENDING, booking.notes
+            execute_prepared(cur, "book_queue", (
+                booking.citizen_name, booking.citizen_phone, booking.citizen_email,
+                booking.service_id, booking.booking_date, booking.booking_time, booking.notes
             ))
             result = cur.fetchone()
             conn.commit()
-            
-            return QueueBookingResponse(
-                **dict(result),
-                province_name=service_info['province_name'],
-                district_name=service_info['district_name'],
-                service_name=service_info['service_name'],
-                province_id=service_info['province_id'],
-                district_id=service_info['district_id']
-            )
+    except psycopg2.IntegrityError as e:
+        if e.diag.message_primary == "duplicate_booking":
+            detail = f"หมายเลขโทรศัพท์นี้จองบริการนี้ในวันดังกล่าวแล้ว (คิว {e.diag.message_detail})"
+        elif is_live_booking_conflict(e):
+            detail = "หมายเลขโทรศัพท์นี้จองบริการนี้ในวันดังกล่าวแล้ว"
+        else:
+            raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการจองคิว: {str(e)}")
+        # Same phone, service and day may hold only one live booking
+        BOOKING_GUARD.labels("duplicate").inc()
+        raise HTTPException(status_code=409, detail=detail)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการจองคิว: {str(e)}")
 
-@app.get("/queue/bookings")
+    if not result:
+        raise HTTPException(status_code=404, detail=f"ไม่พบบริการ ID: {booking.service_id}")
+    return QueueBookingResponse(**dict(result))
+
+# Exactly the QueueBookingResponse fields, so rows can be returned without the model
+QUEUE_BOOKING_COLUMNS = """
+    qb.id, qb.queue_number, qb.citizen_name, qb.citizen_phone, qb.citizen_email,
+    p.name as province_name, d.name as district_name, s.name as service_name,
+    qb.booking_date, qb.booking_time, qb.status, qb.notes, qb.created_at,
+    p.id as province_id, d.id as district_id, s.id as service_id
+"""
+
+# Hot-path statements, prepared once per pooled connection: name -> (parameter types, statement)
+PREPARED_STATEMENTS = {
+    "book_queue": (
+        "VARCHAR, VARCHAR, VARCHAR, INTEGER, DATE, TIME, TEXT",
+        "SELECT * FROM book_queue_v1($1, $2, $3, $4, $5, $6, $7)",
+    ),
+    "get_queue_booking": (
+        "INTEGER",
+        """SELECT """ + QUEUE_BOOKING_COLUMNS + """
+        FROM queue_bookings qb
+        JOIN services s ON qb.service_id = s.id
+        JOIN districts d ON s.district_id = d.id
+        JOIN provinces p ON d.province_id = p.id
+        WHERE qb.id = $1""",
+    ),
+    "update_queue_status": (
+        "INTEGER, VARCHAR",
+        "UPDATE queue_bookings SET status = $2, updated_at = CURRENT_TIMESTAMP WHERE id = $1",
+    ),
+}
+
+def execute_prepared(cur, name: str, params):
+    """EXECUTE a PREPARED_STATEMENTS entry, preparing it first on this connection if needed"""
+    conn = cur.connection
+    prepared = getattr(conn, "prepared_statements", None)
+    if prepared is None:
+        prepared = conn.prepared_statements = set()
+    if name not in prepared:
+        types, statement = PREPARED_STATEMENTS[name]
+        cur.execute(f"PREPARE {name} ({types}) AS {statement}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+def build_queue_bookings_query(
+    province_id: Optional[int] = None,
+    district_id: Optional[int] = None,
+    service_id: Optional[int] = None,
+    booking_date: Optional[date] = None,
+    status: Optional[QueueStatus] = None
+):
+    """Booking listing query and params shared by the list and export endpoints"""
+    query = """
+        SELECT """ + QUEUE_BOOKING_COLUMNS + """
+        FROM queue_bookings qb
+        JOIN services s ON qb.service_id = s.id
+        JOIN districts d ON s.district_id = d.id
+        JOIN provinces p ON d.province_id = p.id
+    """
+    
+    conditions = []
+    params = []
+    
+    if province_id:
+        conditions.append("p.id = %s")
+        params.append(province_id)
+    if district_id:
+        conditions.append("d.id = %s")
+        params.append(district_id)
+    if service_id:
+        conditions.append("s.id = %s")
+        params.append(service_id)
+    if booking_date:
+        conditions.append("qb.booking_date = %s")
+        params.append(booking_date)
+    if status:
+        conditions.append("qb.status = %s")
+        params.append(status.value)
+    
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    
+    query += " ORDER BY qb.booking_date, qb.booking_time"
+    return query, params
+
+@app.get("/queue/bookings", response_model=List[QueueBookingResponse])
 async def list_queue_bookings(
     province_id: Optional[int] = None,
     district_id: Optional[int] = None,
@@ -702,46 +3307,12 @@ async def list_queue_bookings(
     status: Optional[QueueStatus] = None
 ):
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            query = """
-                SELECT qb.*, s.name as service_name, d.name as district_name, p.name as province_name,
-                       s.id as service_id, d.id as district_id, p.id as province_id
-                FROM queue_bookings qb
-                JOIN services s ON qb.service_id = s.id
-                JOIN districts d ON s.district_id = d.id
-                JOIN provinces p ON d.province_id = p.id
-            """
-            
-            conditions = []
-            params = []
-            
-            if province_id:
-                conditions.append("p.id = %s")
-                params.append(province_id)
-            if district_id:
-                conditions.append("d.id = %s")
-                params.append(district_id)
-            if service_id:
-                conditions.append("s.id = %s")
-                params.append(service_id)
-            if booking_date:
-                conditions.append("qb.booking_date = %s")
-                params.append(booking_date)
-            if status:
-                conditions.append("qb.status = %s")
-                params.append(status.value)
-            
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
-            
-            query += " ORDER BY qb.booking_date, qb.booking_time"
-            
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            query, params = build_queue_bookings_query(province_id, district_id, service_id, booking_date, status)
             cur.execute(query, params)
-            results = cur.fetchall()
-            
-            return [QueueBookingResponse(**dict(result)) for result in results]
+            # Rows come straight from our own schema, skip per-row model validation
+            return ORJSONResponse(fetch_rows(cur))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงข้อมูลคิว: {str(e)}")
 
@@ -750,43 +3321,30 @@ async def get_queue_booking(booking_id: int):
     try:
         with get_db_connection() as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("""
-                SELECT qb.*, s.name as service_name, d.name as district_name, p.name as province_name,
-                       s.id as service_id, d.id as district_id, p.id as province_id
-                FROM queue_bookings qb
-                JOIN services s ON qb.service_id = s.id
-                JOIN districts d ON s.district_id = d.id
-                JOIN provinces p ON d.province_id = p.id
-                WHERE qb.id = %s
-            """, (booking_id,))
+            execute_prepared(cur, "get_queue_booking", (booking_id,))
             result = cur.fetchone()
-            
-            if not result:
-                raise HTTPException(status_code=404, detail="ไม่พบการจองคิว")
-            
-            return QueueBookingResponse(**dict(result))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงข้อมูลคิว: {str(e)}")
 
+    if not result:
+        raise HTTPException(status_code=404, detail="ไม่พบการจองคิว")
+    return QueueBookingResponse(**dict(result))
+
 @app.put("/queue/{booking_id}/status")
 async def update_queue_status(booking_id: int, status: QueueStatus):
     try:
         with get_db_connection() as conn:
             cur = conn.cursor()
-            cur.execute("""
-                UPDATE queue_bookings 
-                SET status = %s, updated_at = CURRENT_TIMESTAMP 
-                WHERE id = %s
-            """, (status.value, booking_id))
-            
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="ไม่พบการจองคิว")
-            
+            execute_prepared(cur, "update_queue_status", (booking_id, status.value))
+            updated = cur.rowcount
             conn.commit()
-            return {"message": f"อัปเดตสถานะคิวเป็น {status.value} สำเร็จ"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการอัปเดตสถานะ: {str(e)}")
 
+    if updated == 0:
+        raise HTTPException(status_code=404, detail="ไม่พบการจองคิว")
+    return {"message": f"อัปเดตสถานะคิวเป็น {status.value} สำเร็จ"}
+
 @app.delete("/queue/{booking_id}")
 async def delete_queue_booking(booking_id: int):
     try:
@@ -802,6 +3360,49 @@ async def delete_queue_booking(booking_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการลบการจองคิว: {str(e)}")
 
+@app.post("/queue/maintenance")
+async def queue_maintenance(retention_days: int = QUEUE_RETENTION_DAYS):
+    """Create upcoming monthly partitions and archive old finished bookings"""
+    try:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            created = create_upcoming_queue_partitions(cur)
+            archived, dropped = archive_queue_bookings(cur, retention_days)
+            unpartitioned = default_partition_months(cur)
+            if unpartitioned:
+                logger.warning("queue_bookings_default holds bookings for %s; raise QUEUE_PARTITION_MONTHS_AHEAD "
+                               "or create those partitions in a quiet window",
+                               ", ".join(f"{m['month']} ({m['bookings']})" for m in unpartitioned))
+            cur.execute("""
+                DELETE FROM booking_idempotency
+                WHERE created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+            """, (IDEMPOTENCY_TTL_HOURS,))
+            expired_keys = cur.rowcount
+            # Past days take no new numbers; a late booking re-seeds its counter
+            cur.execute("DELETE FROM queue_counters WHERE booking_date < CURRENT_DATE")
+            pruned_counters = cur.rowcount
+            # Snapshot builds prune what they cover; this bounds the log when none run
+            cur.execute("DELETE FROM document_changes WHERE changed_at < CURRENT_TIMESTAMP - INTERVAL '1 day'")
+            pruned_changes = cur.rowcount
+            cur.execute("""
+                DELETE FROM query_log WHERE logged_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            """, (QUERY_LOG_RETENTION_DAYS,))
+            pruned_queries = cur.rowcount
+            conn.commit()
+            return {
+                "created_partitions": created,
+                "archived_bookings": archived,
+                "dropped_partitions": dropped,
+                "default_partition_months": unpartitioned,
+                "retention_days": retention_days,
+                "expired_idempotency_keys": expired_keys,
+                "pruned_queue_counters": pruned_counters,
+                "pruned_document_changes": pruned_changes,
+                "pruned_query_log": pruned_queries
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดูแลตารางคิว: {str(e)}")
+
 @app.get("/queue/statistics")
 async def get_queue_statistics(
     province_id: Optional[int] = None,
@@ -811,8 +3412,8 @@ async def get_queue_statistics(
     end_date: Optional[date] = None
 ):
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
             
             query = """
                 SELECT 
@@ -854,9 +3455,7 @@ async def get_queue_statistics(
             query += " GROUP BY p.id, p.name, d.id, d.name, s.id, s.name ORDER BY p.name, d.name, s.name"
             
             cur.execute(query, params)
-            results = cur.fetchall()
-            
-            return [dict(result) for result in results]
+            return ORJSONResponse(fetch_rows(cur))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงสถิติคิว: {str(e)}")
 
@@ -864,7 +3463,7 @@ async def get_queue_statistics(
 async def get_structure():
     """Get complete hierarchical structure"""
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             cur.execute("""
                 SELECT
@@ -918,118 +3517,158 @@ async def get_structure():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการโหลดโครงสร้างข้อมูล: {str(e)}")
 
+DOCUMENTS_FROM = """
+    FROM documents d
+    JOIN services s ON d.service_id = s.id
+    JOIN districts dt ON s.district_id = dt.id
+    JOIN provinces p ON dt.province_id = p.id
+"""
+
+# fields= names for /documents and /documents/{id}; content is the only one that reads the full body
+DOCUMENT_FIELDS = {
+    "id": "d.id",
+    "content_preview": "d.content_preview",
+    "content_length": "d.content_length",
+    "page_count": "d.page_count",
+    "summary": "d.summary",
+    "key_facts": "d.key_facts",
+    "summary_status": "d.summary_status",
+    "content": "d.content",
+    "created_at": "d.created_at",
+    "service_id": "s.id as service_id",
+    "service_name": "s.name as service_name",
+    "district_id": "dt.id as district_id",
+    "district_name": "dt.name as district_name",
+    "province_id": "p.id as province_id",
+    "province_name": "p.name as province_name",
+}
+DEFAULT_DOCUMENT_FIELDS = [
+    "id", "content_preview", "content_length", "page_count", "created_at",
+    "service_id", "service_name", "district_id", "district_name", "province_id", "province_name",
+]
+
+def parse_fields(fields: Optional[str], allowed, default) -> List[str]:
+    """Comma-separated fields= value checked against allowed; id always comes back"""
+    if not fields:
+        return list(default)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"ไม่รู้จักฟิลด์: {', '.join(unknown)} (ใช้ได้: {', '.join(allowed)})")
+    return ["id"] + [name for name in dict.fromkeys(names) if name != "id"]
+
+def build_document_filters(
+    province_id: Optional[int] = None,
+    district_id: Optional[int] = None,
+    service_id: Optional[int] = None
+):
+    """WHERE clause and params shared by the document list, count and export"""
+    conditions = []
+    params = []
+    
+    if province_id:
+        conditions.append("p.id = %s")
+        params.append(province_id)
+    if district_id:
+        conditions.append("dt.id = %s")
+        params.append(district_id)
+    if service_id:
+        conditions.append("s.id = %s")
+        params.append(service_id)
+    
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
 @app.get("/documents")
 async def list_documents(
     province_id: Optional[int] = None,
     district_id: Optional[int] = None,
     service_id: Optional[int] = None,
     limit: int = 10,
-    offset: int = 0
+    offset: int = 0,
+    fields: Optional[str] = None
 ):
+    """List documents; full content only when fields= asks for it"""
+    columns = ", ".join(DOCUMENT_FIELDS[name] for name in parse_fields(fields, DOCUMENT_FIELDS, DEFAULT_DOCUMENT_FIELDS))
     try:
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            
-            query = """
-                SELECT d.id, d.content, d.created_at,
-                       s.id as service_id, s.name as service_name,
-                       dt.id as district_id, dt.name as district_name,
-                       p.id as province_id, p.name as province_name
-                FROM documents d
-                JOIN services s ON d.service_id = s.id
-                JOIN districts dt ON s.district_id = dt.id
-                JOIN provinces p ON dt.province_id = p.id
-            """
-            
-            conditions = []
-            params = []
-            
-            if province_id:
-                conditions.append("p.id = %s")
-                params.append(province_id)
-            if district_id:
-                conditions.append("dt.id = %s")
-                params.append(district_id)
-            if service_id:
-                conditions.append("s.id = %s")
-                params.append(service_id)
-            
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            where, params = build_document_filters(province_id, district_id, service_id)
             
-            query += " ORDER BY d.created_at DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
+            query = "SELECT " + columns + DOCUMENTS_FROM + where + " ORDER BY d.created_at DESC LIMIT %s OFFSET %s"
             
-            cur.execute(query, params)
-            results = cur.fetchall()
+            cur.execute(query, params + [limit, offset])
+            documents = fetch_rows(cur)
             
             # Also get total count
-            count_query = """
-                SELECT COUNT(*) as total
-                FROM documents d
-                JOIN services s ON d.service_id = s.id
-                JOIN districts dt ON s.district_id = dt.id
-                JOIN provinces p ON dt.province_id = p.id
-            """
-            
-            count_params = []
-            if province_id:
-                count_query += " WHERE p.id = %s"
-                count_params.append(province_id)
-                if district_id:
-                    count_query += " AND dt.id = %s"
-                    count_params.append(district_id)
-                if service_id:
-                    count_query += " AND s.id = %s"
-                    count_params.append(service_id)
-            elif district_id:
-                count_query += " WHERE dt.id = %s"
-                count_params.append(district_id)
-                if service_id:
-                    count_query += " AND s.id = %s"
-                    count_params.append(service_id)
-            elif service_id:
-                count_query += " WHERE s.id = %s"
-                count_params.append(service_id)
-            
-            cur.execute(count_query, count_params)
-            total = cur.fetchone()['total']
+            cur.execute("SELECT COUNT(*) as total" + DOCUMENTS_FROM + where, params)
+            total = cur.fetchone()[0]
             
-            return {
-                "documents": [dict(result) for result in results],
+            return ORJSONResponse({
+                "documents": documents,
                 "total": total,
                 "limit": limit,
                 "offset": offset
-            }
+            })
             
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงข้อมูลเอกสาร: {str(e)}")
 
 @app.get("/documents/{document_id}")
-async def get_document(document_id: int):
+async def get_document(document_id: int, fields: Optional[str] = None):
+    """One document's metadata and preview; GET /documents/{id}/content pages through the body"""
+    columns = ", ".join(DOCUMENT_FIELDS[name] for name in parse_fields(fields, DOCUMENT_FIELDS, DEFAULT_DOCUMENT_FIELDS))
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute("""
-                SELECT d.id, d.content, d.created_at,
-                       s.id as service_id, s.name as service_name,
-                       dt.id as district_id, dt.name as district_name,
-                       p.id as province_id, p.name as province_name
-                FROM documents d
-                JOIN services s ON d.service_id = s.id
-                JOIN districts dt ON s.district_id = dt.id
-                JOIN provinces p ON dt.province_id = p.id
-                WHERE d.id = %s
-            """, (document_id,))
+            cur.execute("SELECT " + columns + DOCUMENTS_FROM + " WHERE d.id = %s", (document_id,))
             result = cur.fetchone()
-            
-            if not result:
-                raise HTTPException(status_code=404, detail="ไม่พบเอกสาร")
-            
-            return dict(result)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงข้อมูลเอกสาร: {str(e)}")
 
+    if not result:
+        raise HTTPException(status_code=404, detail="ไม่พบเอกสาร")
+    return dict(result)
+
+@app.get("/documents/{document_id}/content")
+async def get_document_content(document_id: int, offset: int = 0, length: int = DOCUMENT_CONTENT_CHUNK):
+    """A character range of the document body; next_offset is null after the last chunk"""
+    if offset < 0 or length < 1:
+        raise HTTPException(status_code=400, detail="offset ต้องไม่ติดลบ และ length ต้องมากกว่า 0")
+    length = min(length, DOCUMENT_CONTENT_CHUNK)
+    try:
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
+            # Paging bounds the response size; Postgres still detoasts the whole
+            # (compressed) value to cut the range
+            cur.execute("""
+                SELECT substr(content, %s, %s), content_length FROM documents WHERE id = %s
+            """, (offset + 1, length, document_id))
+            row = cur.fetchone()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการดึงเนื้อหาเอกสาร: {str(e)}")
+
+    if not row:
+        raise HTTPException(status_code=404, detail="ไม่พบเอกสาร")
+    content, content_length = row
+    end = offset + len(content)
+    return ORJSONResponse({
+        "id": document_id,
+        "offset": offset,
+        "content": content,
+        "content_length": content_length,
+        "next_offset": end if end < content_length else None,
+    })
+
+@app.post("/documents/summaries/backfill")
+async def backfill_document_summaries(background_tasks: BackgroundTasks, limit: int = 100, mode: Optional[str] = None):
+    """Summarize up to limit documents without a finished summary, after responding"""
+    mode = (mode or SUMMARY_MODE).lower()
+    if mode not in ("extractive", "llm"):
+        raise HTTPException(status_code=400, detail="mode ต้องเป็น extractive หรือ llm")
+    background_tasks.add_task(summarize_pending_documents, limit, mode)
+    return {"message": f"เริ่มสรุปเอกสารสูงสุด {limit} รายการ", "mode": mode}
+
 @app.delete("/documents/{document_id}")
 async def delete_document(document_id: int):
     try:
@@ -1040,6 +3679,7 @@ async def delete_document(document_id: int):
             if cur.rowcount == 0:
                 raise HTTPException(status_code=404, detail="ไม่พบเอกสาร")
             
+            invalidate_semantic_cache_for_documents(cur, [document_id])
             conn.commit()
             return {"message": "ลบเอกสารสำเร็จ"}
     except Exception as e:
@@ -1052,7 +3692,7 @@ async def get_document_count(
     service_id: Optional[int] = None
 ):
     try:
-        with get_db_connection() as conn:
+        with get_db_connection(readonly=True) as conn:
             cur = conn.cursor(cursor_factory=RealDictCursor)
             
             if service_id:
@@ -1142,35 +3782,306 @@ async def get_document_count(
 
 @app.get("/search/suggestions")
 async def get_search_suggestions(query: str):
-    """Get search suggestions based on document content"""
+    """Get search suggestions from the leading text of each document (content_preview)"""
     try:
         if len(query.strip()) < 2:
             return {"suggestions": []}
         
-        with get_db_connection() as conn:
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor()
             
             # ค้นหาในทุกเอกสาร ไม่มีการ filter
+            # content_preview is short and trigram-indexed; matching content would
+            # detoast and decompress every document
             base_query = """
                 SELECT DISTINCT 
-                    SUBSTRING(d.content, 1, 100) as content_preview,
+                    left(d.content_preview, 100) as content_preview,
                     s.name AS service, dt.name AS district, p.name AS province,
                     s.id as service_id, dt.id as district_id, p.id as province_id
                 FROM documents d
                 JOIN services s ON d.service_id = s.id
                 JOIN districts dt ON s.district_id = dt.id
                 JOIN provinces p ON dt.province_id = p.id
-                WHERE d.content ILIKE %s
+                WHERE d.content_preview ILIKE %s
                 LIMIT 10
             """
             
             cur.execute(base_query, [f"%{query}%"])
-            results = cur.fetchall()
-            
-            return {"suggestions": [dict(result) for result in results]}
+            return ORJSONResponse({"suggestions": fetch_rows(cur)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการค้นหาคำแนะนำ: {str(e)}")
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+def _export_value(value):
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+def stream_export(query: str, params: list, export_format: ExportFormat, filename: str) -> StreamingResponse:
+    """Stream a query result as CSV or NDJSON from a named server-side cursor.
+
+    Rows are fetched and encoded EXPORT_BATCH_SIZE at a time, so memory stays
+    flat however large the export is. The generator runs in the threadpool and
+    holds its connection until the client has read everything.
+    """
+    def chunks():
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor(name="export_stream")
+            cur.itersize = EXPORT_BATCH_SIZE
+            cur.execute(query, params)
+            first = True
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH_SIZE)
+                columns = [column[0] for column in cur.description]
+                buffer = io.StringIO()
+                if export_format == ExportFormat.CSV:
+                    writer = csv.writer(buffer)
+                    if first:
+                        # BOM so spreadsheet tools pick up the Thai text as UTF-8
+                        buffer.write("\ufeff")
+                        writer.writerow(columns)
+                    writer.writerows(rows)
+                else:
+                    for row in rows:
+                        buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=_export_value))
+                        buffer.write("\n")
+                first = False
+                if buffer.tell():
+                    yield buffer.getvalue().encode("utf-8")
+                if not rows:
+                    break
+            conn.rollback()
+
+    if export_format == ExportFormat.CSV:
+        media_type = "text/csv; charset=utf-8"
+    else:
+        media_type = "application/x-ndjson"
+    return StreamingResponse(chunks(), media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}.{export_format.value}"'
+    })
+
+@app.get("/export/bookings")
+async def export_queue_bookings(
+    format: ExportFormat = ExportFormat.CSV,
+    province_id: Optional[int] = None,
+    district_id: Optional[int] = None,
+    service_id: Optional[int] = None,
+    booking_date: Optional[date] = None,
+    status: Optional[QueueStatus] = None
+):
+    """Export bookings with the same filters as /queue/bookings"""
+    query, params = build_queue_bookings_query(province_id, district_id, service_id, booking_date, status)
+    return stream_export(query, params, format, "bookings")
+
+@app.get("/export/documents")
+async def export_documents(
+    format: ExportFormat = ExportFormat.CSV,
+    province_id: Optional[int] = None,
+    district_id: Optional[int] = None,
+    service_id: Optional[int] = None
+):
+    """Export documents with the same filters as /documents, without paging"""
+    where, params = build_document_filters(province_id, district_id, service_id)
+    query = """
+        SELECT d.id, d.content, d.created_at,
+               s.id as service_id, s.name as service_name,
+               dt.id as district_id, dt.name as district_name,
+               p.id as province_id, p.name as province_name
+    """ + DOCUMENTS_FROM + where + " ORDER BY d.created_at DESC"
+    return stream_export(query, params, format, "documents")
+
+@app.get("/vector-index/status")
+async def get_vector_index_status():
+    """State of the in-process index used when RETRIEVAL_BACKEND=memory"""
+    return {"retrieval_backend": RETRIEVAL_BACKEND, **memory_index.status()}
+
+@app.get("/vector-storage/report")
+async def get_vector_storage_report(sample: int = 20, k: int = 10):
+    """Compare footprint and recall@k of the quantized storage modes against exact search.
+
+    documents.embedding stays vector(dim) in every mode; a mode only adds its
+    quantized HNSW index, so index_bytes is the real cost of each mode.
+    """
+    try:
+        with get_db_connection(readonly=True) as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                SELECT COUNT(*) AS documents,
+                       COALESCE(SUM(pg_column_size(embedding)), 0) AS heap_bytes,
+                       COALESCE(AVG(pg_column_size(embedding)), 0) AS vector,
+                       COALESCE(AVG(pg_column_size(embedding::halfvec({EMBEDDING_DIM}))), 0) AS halfvec,
+                       COALESCE(AVG(pg_column_size(binary_quantize(embedding)::bit({EMBEDDING_DIM}))), 0) AS binary
+                FROM documents
+                WHERE embedding IS NOT NULL
+            """)
+            sizes = cur.fetchone()
+            # What one row would take if the column itself were migrated to the mode's type
+            hypothetical_bytes_per_row = {mode: float(sizes[mode]) for mode in VECTOR_STORAGE_MODES}
+
+            cur.execute("""
+                SELECT indexrelname AS name, pg_relation_size(indexrelid) AS bytes
+                FROM pg_stat_user_indexes
+                WHERE relname = 'documents' AND indexrelname LIKE 'idx_document_embedding%'
+            """)
+            indexes = {row['name']: row['bytes'] for row in cur.fetchall()}
+
+            # Without its HNSW index a quantized mode would fall back to an exact
+            # scan and report perfect recall, so only measure modes that have one
+            cur.execute("""
+                SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indrelid = 'documents'::regclass AND i.indisvalid
+            """)
+            built = {row['relname'] for row in cur.fetchall()}
+            measured = ["vector"] + [
+                mode for mode, suffix in VECTOR_INDEX_SUFFIXES.items()
+                if f"idx_document_embedding_{suffix}" in built
+            ]
+
+            cur.execute("""
+                SELECT id, embedding::text AS embedding FROM documents
+                WHERE embedding IS NOT NULL
+                ORDER BY random() LIMIT %s
+            """, (sample,))
+            queries = cur.fetchall()
+
+            recall = {mode: 0.0 for mode in measured}
+            latency = {mode: 0.0 for mode in measured}
+            for query in queries:
+                found = {}
+                for mode in measured:
+                    started = time.perf_counter()
+                    rows = execute_vector_search(cur, query['embedding'], storage=mode, limit=k + 1)
+                    latency[mode] += (time.perf_counter() - started) * 1000
+                    # The sampled document is its own nearest neighbour, leave it out
+                    found[mode] = [row['id'] for row in rows if row['id'] != query['id']][:k]
+
+                exact = set(found["vector"])
+                for mode in measured:
+                    if exact:
+                        recall[mode] += len(exact.intersection(found[mode])) / len(exact)
+
+            count = len(queries) or 1
+            return {
+                "documents": sizes['documents'],
+                "active_storage": VECTOR_STORAGE,
+                "heap_bytes": sizes['heap_bytes'],
+                # vector searches exactly and has no ANN index; None for quantized modes not built
+                "index_bytes": {
+                    "vector": 0,
+                    **{mode: indexes.get(f"idx_document_embedding_{suffix}")
+                       for mode, suffix in VECTOR_INDEX_SUFFIXES.items()},
+                },
+                "hypothetical_bytes_per_row": hypothetical_bytes_per_row,
+                "k": k,
+                "sample": len(queries),
+                "recall_at_k": {mode: recall[mode] / count for mode in measured},
+                "avg_latency_ms": {mode: latency[mode] / count for mode in measured},
+                # No ANN index built for these modes; see vector_index_statements
+                "unavailable": [mode for mode in VECTOR_STORAGE_MODES if mode not in measured],
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"เกิดข้อผิดพลาดในการสร้างรายงานการจัดเก็บเวกเตอร์: {str(e)}")
+
+# Inference worker: owns the embedding model for API workers running
+# EMBEDDING_BACKEND=remote. Generation stays with the Ollama server (OLLAMA_HOST).
+inference_app = FastAPI(title="Embedding inference", default_response_class=ORJSONResponse)
+
+class EmbedRequest(BaseModel):
+    texts: List[str]
+
+@inference_app.on_event("startup")
+async def start_inference_warmup():
+    threading.Thread(target=warm_up, kwargs={"check_database": False}, name="warmup", daemon=True).start()
+
+@inference_app.post("/embed")
+def embed_texts(embed_request: EmbedRequest):
+    with stage("embed"):
+        vectors = get_embedder().encode(embed_request.texts)
+    return {"embeddings": np.asarray(vectors, dtype=np.float32).tolist()}
+
+inference_app.add_api_route("/health/live", health_live)
+inference_app.add_api_route("/health/ready", health_ready)
+inference_app.add_api_route("/metrics", metrics)
+
+# Offline cache pre-warming from the query log
+def popular_questions(days: int, limit: int):
+    """(question, scope_key, times asked) for the most asked normalized questions of the last days"""
+    with get_db_connection(readonly=True) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT question, scope_key, COUNT(*) AS asked FROM query_log
+            WHERE logged_at > CURRENT_TIMESTAMP - make_interval(days => %s)
+            GROUP BY question, scope_key
+            ORDER BY asked DESC
+            LIMIT %s
+        """, (days, limit))
+        return cur.fetchall()
+
+def cluster_questions(rows, embeddings, similarity: float) -> List[dict]:
+    """Greedy clustering: a question joins the first more-asked question of its scope it is similar to"""
+    vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+    clusters = []
+    for (question, scope_key, asked), embedding, vector in zip(rows, embeddings, vectors):
+        for cluster in clusters:
+            if cluster["scope_key"] == scope_key and float(cluster["vector"] @ vector) >= similarity:
+                cluster["asked"] += asked
+                cluster["questions"] += 1
+                break
+        else:
+            clusters.append({"question": question, "scope_key": scope_key, "embedding": embedding,
+                             "vector": vector, "asked": asked, "questions": 1})
+    return sorted(clusters, key=lambda cluster: cluster["asked"], reverse=True)
+
+def prewarm_cache(days: int = 7, top: int = 200, min_asked: int = 3,
+                  similarity: float = 1 - SEMANTIC_CACHE_MAX_DISTANCE, fresh_hours: float = 24) -> dict:
+    """Store embeddings of frequent questions and cached answers for the most asked clusters.
+
+    A cluster is what one semantic_cache entry serves, so the default
+    similarity matches SEMANTIC_CACHE_MAX_DISTANCE. Clusters whose entry
+    would expire within fresh_hours are answered again.
+    """
+    started = time.perf_counter()
+    rows = [row for row in popular_questions(days, top * 10) if row[2] >= min_asked]
+    if not rows:
+        return {"questions": 0, "clusters": 0, "already_warm": 0, "generated": 0, "seconds": 0.0}
+    with stage("embed"):
+        embeddings = [list(map(float, vector)) for vector in get_embedder().encode([question for question, _, _ in rows])]
+
+    # Repeat askers of these questions skip the embedding model
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, """
+            INSERT INTO question_embeddings (question, embedding) VALUES %s
+            ON CONFLICT (question) DO UPDATE SET embedding = EXCLUDED.embedding, created_at = CURRENT_TIMESTAMP
+        """, list({question: (question, embedding) for (question, _, _), embedding in zip(rows, embeddings)}.values()),
+            template="(%s, %s::vector)")
+        cur.execute("""
+            DELETE FROM question_embeddings WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        """, (days,))
+        conn.commit()
+
+    # Answers only help when /query reads the semantic cache
+    clusters = cluster_questions(rows, embeddings, similarity)[:top] if SEMANTIC_CACHE else []
+    warm = generated = 0
+    for cluster in clusters:
+        service_id = cluster["scope_key"] or None
+        try:
+            if lookup_semantic_cache(cluster["embedding"], service_id,
+                                     max_age_hours=SEMANTIC_CACHE_TTL_HOURS - fresh_hours) is not None:
+                warm += 1
+                continue
+            docs = search_documents_by_embedding(cluster["embedding"], service_id=service_id)
+            if not docs:
+                continue
+            answer = generate_answer_with_ollama(cluster["question"], docs)
+            store_semantic_cache(cluster["question"], cluster["embedding"], service_id, docs,
+                                 [relevant_document(doc) for doc in docs], answer)
+            generated += 1
+        except Exception as e:
+            logger.warning("prewarm of %r failed: %s", cluster["question"], e)
+    return {
+        "questions": len(rows),
+        "clusters": len(clusters),
+        "already_warm": warm,
+        "generated": generated,
+        "seconds": time.perf_counter() - started,
+    }
@@ -0,0 +1,249 @@
+"""Rebuild documents.embedding with a new embedding model or dimension.
+
+The job is resumable and runs next to a serving API:
+
+1. ``documents.embedding_next`` (nullable shadow column) is added.
+2. Rows whose shadow value is still NULL are streamed through a named
+   server-side cursor, encoded in large batches and written back through
+   ``COPY`` into a temp table plus one set-based UPDATE per batch.
+3. The ANN index for VECTOR_STORAGE is built on the shadow column with
+   ``CREATE INDEX CONCURRENTLY``.
+4. With ``--switch`` the columns and indexes are swapped in one short
+   transaction; the previous vectors stay in ``embedding_old`` until
+   ``--drop-old``.
+
+Interrupting the job at any point and running it again continues where it
+stopped. Roll the API workers onto the new EMBEDDING_MODEL/EMBEDDING_DIM right
+after the switch; until then they embed queries with the old model.
+
+    python reembed.py --model BAAI/bge-m3 --dim 512 --batch-size 128
+    python reembed.py --model BAAI/bge-m3 --dim 512 --switch
+"""
+import argparse
+import io
+import time
+
+from main import (
+    DOCUMENT_CHANGES_UPDATE_TRIGGER,
+    VECTOR_INDEX_SUFFIXES,
+    VECTOR_STORAGE,
+    get_db_connection,
+    load_embedder,
+    vector_index_statements,
+)
+
+SHADOW_COLUMN = "embedding_next"
+OLD_COLUMN = "embedding_old"
+INDEX_PREFIX = "idx_document_embedding"
+
+def column_dimension(cur, column: str):
+    cur.execute("""
+        SELECT atttypmod FROM pg_attribute
+        WHERE attrelid = 'documents'::regclass AND attname = %s AND NOT attisdropped
+    """, (column,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def prepare_shadow_column(dim: int, restart: bool):
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        existing = column_dimension(cur, SHADOW_COLUMN)
+        if existing is not None and (restart or existing != dim):
+            if not restart:
+                raise SystemExit(f"documents.{SHADOW_COLUMN} is vector({existing}); rerun with --restart to rebuild it as vector({dim})")
+            cur.execute(f"ALTER TABLE documents DROP COLUMN {SHADOW_COLUMN}")
+            existing = None
+        if existing is None:
+            cur.execute(f"ALTER TABLE documents ADD COLUMN {SHADOW_COLUMN} vector({dim})")
+        cur.execute(f"""
+            SELECT COUNT(*) FILTER (WHERE {SHADOW_COLUMN} IS NULL), COUNT(*) FROM documents
+        """)
+        pending, total = cur.fetchone()
+        conn.commit()
+        return pending, total
+
+def vector_literal(values) -> str:
+    return "[" + ",".join(f"{float(value):.8g}" for value in values) + "]"
+
+def write_batch(cur, dim: int, ids, vectors):
+    """COPY a batch into the session temp table and apply it with one UPDATE"""
+    buffer = io.StringIO()
+    for doc_id, vector in zip(ids, vectors):
+        buffer.write(f"{doc_id}\t{vector_literal(vector)}\n")
+    buffer.seek(0)
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS reembed_batch (id INTEGER PRIMARY KEY, embedding vector({dim}))
+        ON COMMIT DELETE ROWS
+    """)
+    cur.copy_expert("COPY reembed_batch (id, embedding) FROM STDIN", buffer)
+    cur.execute(f"""
+        UPDATE documents d SET {SHADOW_COLUMN} = b.embedding
+        FROM reembed_batch b
+        WHERE d.id = b.id
+    """)
+
+def encode(model, contents, batch_size: int):
+    return model.encode(contents, batch_size=batch_size, show_progress_bar=False)
+
+def backfill(model, dim: int, batch_size: int, total_pending: int):
+    """Encode every row whose shadow value is NULL, repeating until none are left"""
+    done = 0
+    started = time.perf_counter()
+    while True:
+        progressed = 0
+        with get_db_connection() as read_conn, get_db_connection() as write_conn:
+            read_cur = read_conn.cursor(name="reembed_stream")
+            read_cur.itersize = batch_size
+            read_cur.execute(f"SELECT id, content FROM documents WHERE {SHADOW_COLUMN} IS NULL ORDER BY id")
+            write_cur = write_conn.cursor()
+
+            while True:
+                rows = read_cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                batch_started = time.perf_counter()
+                vectors = encode(model, [content for _, content in rows], batch_size)
+                write_batch(write_cur, dim, [doc_id for doc_id, _ in rows], vectors)
+                write_conn.commit()
+
+                progressed += len(rows)
+                done += len(rows)
+                batch_rate = len(rows) / (time.perf_counter() - batch_started)
+                overall_rate = done / (time.perf_counter() - started)
+                print(f"{done}/{max(total_pending, done)} documents  batch {batch_rate:.1f} doc/s  overall {overall_rate:.1f} doc/s", flush=True)
+            read_conn.rollback()
+
+        # Rows inserted while streaming were not in the cursor's snapshot
+        if not progressed:
+            break
+    return done, time.perf_counter() - started
+
+def drop_invalid_indexes(cur):
+    """A failed CONCURRENTLY build leaves an INVALID index behind; clear it so a rerun rebuilds"""
+    cur.execute("""
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = 'documents'::regclass AND NOT i.indisvalid AND c.relname LIKE %s
+    """, (f"{INDEX_PREFIX}_next%",))
+    for (name,) in cur.fetchall():
+        print(f"dropping invalid index {name}")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+def build_index(dim: int):
+    statements = vector_index_statements(VECTOR_STORAGE, column=SHADOW_COLUMN, dim=dim,
+                                         index_prefix=f"{INDEX_PREFIX}_next", concurrently=True)
+    if not statements:
+        return
+    with get_db_connection() as conn:
+        conn.autocommit = True
+        cur = conn.cursor()
+        drop_invalid_indexes(cur)
+        for statement in statements:
+            started = time.perf_counter()
+            cur.execute(statement)
+            print(f"built {VECTOR_STORAGE} index on {SHADOW_COLUMN} in {time.perf_counter() - started:.1f}s")
+
+def rename_index(cur, old: str, new: str):
+    cur.execute("SELECT to_regclass(%s)", (old,))
+    if cur.fetchone()[0]:
+        cur.execute(f"ALTER INDEX {old} RENAME TO {new}")
+
+def embed_stragglers(model, dim: int, batch_size: int) -> int:
+    """Embed rows inserted since the backfill, outside any table lock"""
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT id, content FROM documents WHERE {SHADOW_COLUMN} IS NULL ORDER BY id")
+        stragglers = cur.fetchall()
+        if stragglers:
+            vectors = encode(model, [content for _, content in stragglers], batch_size)
+            write_batch(cur, dim, [doc_id for doc_id, _ in stragglers], vectors)
+        conn.commit()
+    return len(stragglers)
+
+def switch_over(model, dim: int, batch_size: int, attempts: int = 5):
+    """Swap embedding_next in as embedding within one transaction"""
+    late = 0
+    for _ in range(attempts):
+        late += embed_stragglers(model, dim, batch_size)
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            if column_dimension(cur, OLD_COLUMN) is not None:
+                raise SystemExit(f"documents.{OLD_COLUMN} still exists from a previous switch; run --drop-old first")
+
+            # RENAME COLUMN needs ACCESS EXCLUSIVE, so readers block too until
+            # commit; nothing slow may run while it is held. A row inserted
+            # since embed_stragglers sends us back to embed it unlocked.
+            cur.execute("SET LOCAL lock_timeout = '10s'")
+            cur.execute("LOCK TABLE documents IN ACCESS EXCLUSIVE MODE")
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM documents WHERE {SHADOW_COLUMN} IS NULL)")
+            if cur.fetchone()[0]:
+                conn.rollback()
+                continue
+
+            cur.execute(f"ALTER TABLE documents RENAME COLUMN embedding TO {OLD_COLUMN}")
+            cur.execute(f"ALTER TABLE documents RENAME COLUMN {SHADOW_COLUMN} TO embedding")
+            for suffix in VECTOR_INDEX_SUFFIXES.values():
+                rename_index(cur, f"{INDEX_PREFIX}_{suffix}", f"{INDEX_PREFIX}_old_{suffix}")
+                rename_index(cur, f"{INDEX_PREFIX}_next_{suffix}", f"{INDEX_PREFIX}_{suffix}")
+            # Cached answers and prewarmed question embeddings came from the old model
+            for table in ("semantic_cache", "question_embeddings"):
+                cur.execute("SELECT to_regclass(%s)", (table,))
+                if cur.fetchone()[0]:
+                    cur.execute(f"TRUNCATE {table}")
+                    cur.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE vector({dim})")
+            # The renames fire no trigger; a NULL change makes RETRIEVAL_BACKEND=memory workers rebuild
+            cur.execute("SELECT to_regclass('document_changes')")
+            if cur.fetchone()[0]:
+                cur.execute(DOCUMENT_CHANGES_UPDATE_TRIGGER)
+                cur.execute("INSERT INTO document_changes (document_id) VALUES (NULL)")
+                cur.execute("SELECT pg_notify('document_changes', 'SWITCH')")
+            conn.commit()
+            print(f"switched documents.embedding to vector({dim}) ({late} late documents embedded before the switch)")
+            return
+    raise SystemExit(f"documents kept receiving inserts during {attempts} switch attempts; rerun with --switch")
+
+def drop_old():
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"ALTER TABLE documents DROP COLUMN IF EXISTS {OLD_COLUMN}")
+        conn.commit()
+        print(f"dropped documents.{OLD_COLUMN}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", required=True, help="sentence-transformers model name or path")
+    parser.add_argument("--dim", type=int, required=True, help="embedding dimension of the new column")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"])
+    parser.add_argument("--model-file", help="ONNX file inside the model repository")
+    parser.add_argument("--quantize", default="", choices=["", "int8"])
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--max-seq-length", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--restart", action="store_true", help="discard an existing shadow column and start over")
+    parser.add_argument("--switch", action="store_true", help="swap the shadow column in once it is complete")
+    parser.add_argument("--drop-old", action="store_true", help="drop the pre-switch embedding column and stop")
+    args = parser.parse_args()
+
+    if args.drop_old:
+        drop_old()
+        return
+
+    model = load_embedder(model_name=args.model, backend=args.backend, model_file=args.model_file,
+                          quantize=args.quantize, threads=args.threads,
+                          max_seq_length=args.max_seq_length, dim=args.dim)
+
+    pending, total = prepare_shadow_column(args.dim, args.restart)
+    print(f"{pending} of {total} documents need embeddings from {args.model} (dim {args.dim})")
+
+    done, seconds = backfill(model, args.dim, args.batch_size, pending)
+    if done:
+        print(f"embedded {done} documents in {seconds:.1f}s ({done / seconds:.1f} doc/s)")
+
+    build_index(args.dim)
+
+    if args.switch:
+        switch_over(model, args.dim, args.batch_size)
+    else:
+        print("shadow column is ready; rerun with --switch to make it live")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Integration tests; they need a scratch Postgres database with pgvector.
+
+    TEST_DATABASE_URL=postgresql://user@localhost:5432/scratch python -m pytest tests
+
+The database is migrated with init_database(). Each test books against its
+own province/district/service, removed afterwards, so tests do not see each
+other's bookings. Without TEST_DATABASE_URL every test is skipped.
+"""
+import os
+import uuid
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+if TEST_DATABASE_URL:
+    # main reads its configuration at import time
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    os.environ["BOOKING_RATE_LIMIT"] = "0"
+    os.environ["QUERY_LOG"] = "0"
+
+@pytest.fixture(scope="session")
+def app_module():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    import main
+    main.init_database()
+    return main
+
+@pytest.fixture
+def service_id(app_module):
+    """A fresh service under its own province; the cascade removes its documents and bookings"""
+    name = f"test-{uuid.uuid4().hex[:12]}"
+    with app_module.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO provinces (name) VALUES (%s) RETURNING id", (name,))
+        province_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO districts (name, province_id) VALUES (%s, %s) RETURNING id", (name, province_id))
+        district_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO services (name, district_id) VALUES (%s, %s) RETURNING id", (name, district_id))
+        service_id = cur.fetchone()[0]
+        conn.commit()
+    yield service_id
+    with app_module.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM provinces WHERE id = %s", (province_id,))
+        conn.commit()
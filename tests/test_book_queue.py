@@ -0,0 +1,56 @@
+"""Queue numbering by book_queue_v1: one counter per service and day"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time as dtime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+BOOKING_DAY = date.today() + timedelta(days=1)
+
+def book(main, service_id: int, phone: str, day: date = BOOKING_DAY):
+    return main.create_booking(main.QueueBookingCreate(
+        citizen_name="ทดสอบ", citizen_phone=phone, service_id=service_id,
+        booking_date=day, booking_time=dtime(9, 0),
+    ))
+
+def numbers(bookings) -> list:
+    return sorted(int(booking.queue_number[-3:]) for booking in bookings)
+
+def test_concurrent_bookings_get_unique_gap_free_numbers(app_module, service_id):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        bookings = list(pool.map(lambda n: book(app_module, service_id, f"08{n:08d}"), range(40)))
+
+    prefix = f"Q{service_id:03d}{BOOKING_DAY:%m%d}"
+    assert all(booking.queue_number.startswith(prefix) for booking in bookings)
+    assert numbers(bookings) == list(range(1, 41))
+
+def test_each_day_counts_from_one(app_module, service_id):
+    first = [book(app_module, service_id, f"081000000{n}") for n in range(3)]
+    next_day = [book(app_module, service_id, f"081000000{n}", BOOKING_DAY + timedelta(days=1)) for n in range(2)]
+    assert numbers(first) == [1, 2, 3]
+    assert numbers(next_day) == [1, 2]
+
+def test_numbers_are_not_reused_after_a_delete(app_module, service_id):
+    bookings = [book(app_module, service_id, f"082000000{n}") for n in range(3)]
+    with app_module.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM queue_bookings WHERE id = %s AND booking_date = %s",
+                    (bookings[1].id, BOOKING_DAY))
+        conn.commit()
+    assert numbers([book(app_module, service_id, "0820000009")]) == [4]
+
+def test_pruned_counter_reseeds_from_the_highest_number(app_module, service_id):
+    book(app_module, service_id, "0830000000")
+    book(app_module, service_id, "0830000001")
+    with app_module.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM queue_counters WHERE service_id = %s", (service_id,))
+        conn.commit()
+    assert numbers([book(app_module, service_id, "0830000002")]) == [3]
+
+def test_second_live_booking_for_a_phone_is_rejected(app_module, service_id):
+    book(app_module, service_id, "0840000000")
+    with pytest.raises(HTTPException) as rejected:
+        book(app_module, service_id, "0840000000")
+    assert rejected.value.status_code == 409
+    assert numbers([book(app_module, service_id, "0840000001")]) == [2]
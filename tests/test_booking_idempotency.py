@@ -0,0 +1,79 @@
+"""Idempotency-Key on POST /queue/book: replay, payload mismatch, in-flight and failed requests"""
+import hashlib
+import uuid
+from datetime import date, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+@pytest.fixture
+def client(app_module):
+    # Not entered as a context manager: startup would start warming up the embedding model
+    return TestClient(app_module.app)
+
+def booking(service_id: int, **changes) -> dict:
+    return {
+        "citizen_name": "ทดสอบ",
+        "citizen_phone": "0890000000",
+        "service_id": service_id,
+        "booking_date": (date.today() + timedelta(days=1)).isoformat(),
+        "booking_time": "10:00:00",
+        **changes,
+    }
+
+def book(client, payload: dict, key: str):
+    return client.post("/queue/book", json=payload, headers={"Idempotency-Key": key})
+
+def bookings_for(main, service_id: int) -> int:
+    with main.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM queue_bookings WHERE service_id = %s", (service_id,))
+        return cur.fetchone()[0]
+
+def test_retry_replays_the_stored_booking(app_module, client, service_id):
+    key = uuid.uuid4().hex
+    first = book(client, booking(service_id), key)
+    retry = book(client, booking(service_id), key)
+
+    assert first.status_code == 200
+    assert retry.status_code == 200
+    assert retry.headers.get("Idempotent-Replayed") == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.json() == first.json()
+    assert bookings_for(app_module, service_id) == 1
+
+def test_key_reused_with_another_payload_is_rejected(app_module, client, service_id):
+    key = uuid.uuid4().hex
+    assert book(client, booking(service_id), key).status_code == 200
+
+    other = book(client, booking(service_id, citizen_phone="0890000001"), key)
+
+    assert other.status_code == 422
+    assert bookings_for(app_module, service_id) == 1
+
+def test_key_of_a_request_in_flight_is_busy(app_module, client, service_id):
+    key = uuid.uuid4().hex
+    payload = booking(service_id)
+    # What the first request holds between claiming the key and storing its response
+    request_hash = hashlib.sha256(
+        app_module.QueueBookingCreate(**payload).model_dump_json().encode()
+    ).hexdigest()
+    assert app_module.claim_idempotency_key(key, request_hash) is None
+
+    busy = book(client, payload, key)
+
+    assert busy.status_code == 409
+    assert busy.headers.get("Retry-After") == "1"
+    assert bookings_for(app_module, service_id) == 0
+
+def test_failed_booking_releases_its_key(app_module, client, service_id):
+    key = uuid.uuid4().hex
+    assert book(client, booking(service_id), uuid.uuid4().hex).status_code == 200
+
+    # Same phone, service and day: rejected, and the key is free for a corrected retry
+    duplicate = book(client, booking(service_id), key)
+    corrected = book(client, booking(service_id, citizen_phone="0890000002"), key)
+
+    assert duplicate.status_code == 409
+    assert corrected.status_code == 200
+    assert bookings_for(app_module, service_id) == 2
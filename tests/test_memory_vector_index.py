@@ -0,0 +1,96 @@
+"""MemoryVectorIndex keeps up with document_changes: inserts, updates, deletes and rebuilds"""
+import numpy as np
+import pytest
+
+@pytest.fixture
+def index(app_module, tmp_path):
+    index = app_module.MemoryVectorIndex(str(tmp_path), dtype="float32")
+    index.sync()
+    return index
+
+def axis(main, position: int) -> list:
+    """A unit vector, so the nearest document is unambiguous"""
+    vector = np.zeros(main.EMBEDDING_DIM, dtype=np.float32)
+    vector[position] = 1.0
+    return vector.tolist()
+
+def near_axis(main, position: int, other: int) -> list:
+    """Mostly along position, so it is the runner-up to that axis's own document"""
+    vector = np.zeros(main.EMBEDDING_DIM, dtype=np.float32)
+    vector[position], vector[other] = 0.8, 0.6
+    return vector.tolist()
+
+def execute(main, sql: str, params=()):
+    with main.get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        row = cur.fetchone() if cur.description else None
+        conn.commit()
+    return row
+
+def insert_document(main, service_id: int, embedding: list) -> int:
+    return execute(main, "INSERT INTO documents (content, service_id, embedding) VALUES (%s, %s, %s::vector) RETURNING id",
+                   ("เอกสารทดสอบ", service_id, str(embedding)))[0]
+
+def nearest(index, main, service_id: int, position: int, limit: int = 1) -> list:
+    return [doc["id"] for doc in index.search(axis(main, position), limit=limit, service_id=service_id)]
+
+def test_insert_is_searchable_after_sync(app_module, index, service_id):
+    doc_id = insert_document(app_module, service_id, axis(app_module, 1))
+    generation = index.state.generation
+
+    index.sync()
+
+    assert nearest(index, app_module, service_id, 1) == [doc_id]
+    # Folded into the delta, not a rebuild
+    assert index.state.generation == generation
+    assert doc_id in index.state.delta
+
+def test_update_of_a_snapshot_row_moves_it(app_module, tmp_path, service_id):
+    doc_id = insert_document(app_module, service_id, axis(app_module, 2))
+    other_id = insert_document(app_module, service_id, near_axis(app_module, 2, 4))
+    index = app_module.MemoryVectorIndex(str(tmp_path), dtype="float32")
+    index.sync()
+    assert nearest(index, app_module, service_id, 2) == [doc_id]
+
+    execute(app_module, "UPDATE documents SET embedding = %s::vector WHERE id = %s", (str(axis(app_module, 3)), doc_id))
+    index.sync()
+
+    assert nearest(index, app_module, service_id, 3) == [doc_id]
+    # The stale snapshot row is masked, so the old direction now finds the other document
+    assert nearest(index, app_module, service_id, 2) == [other_id]
+
+def test_changed_summary_drops_cached_metadata(app_module, index, service_id):
+    doc_id = insert_document(app_module, service_id, axis(app_module, 5))
+    index.sync()
+    assert index.search(axis(app_module, 5), service_id=service_id)[0]["summary"] is None
+
+    execute(app_module, "UPDATE documents SET summary = 'สรุปใหม่' WHERE id = %s", (doc_id,))
+    index.sync()
+
+    assert index.search(axis(app_module, 5), service_id=service_id)[0]["summary"] == "สรุปใหม่"
+
+def test_delete_removes_the_document(app_module, index, service_id):
+    doc_id = insert_document(app_module, service_id, axis(app_module, 6))
+    index.sync()
+    assert nearest(index, app_module, service_id, 6) == [doc_id]
+
+    execute(app_module, "DELETE FROM documents WHERE id = %s", (doc_id,))
+    index.sync()
+
+    assert nearest(index, app_module, service_id, 6) == []
+
+def test_null_change_forces_a_rebuild(app_module, index, service_id):
+    doc_id = insert_document(app_module, service_id, axis(app_module, 7))
+    index.sync()
+    generation = index.state.generation
+    assert doc_id in index.state.delta
+
+    # What TRUNCATE and reembed.py --switch leave behind
+    execute(app_module, "INSERT INTO document_changes (document_id) VALUES (NULL)")
+    assert index.apply_changes() is None
+    index.sync()
+
+    assert index.state.generation != generation
+    assert index.state.delta == {}
+    assert nearest(index, app_module, service_id, 7) == [doc_id]